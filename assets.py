@@ -0,0 +1,45 @@
+import os
+try: import json
+except ImportError: import simplejson as json
+
+#asset table written by make.py make_assets. It maps asset paths such as
+#Tests/css/base.css to [fingerprinted name, mtime, size, copy], the
+#fingerprinted name (e.g. base.1a2b3c4d.css) being that of a copy of the
+#asset which can be cached forever. The copies are kept under dir, apart
+#from the source tree, and the dev server maps fingerprinted urls there.
+class Assets:
+    def __init__(self, path='.build/assets.json', dir='.build/assets/'):
+        self.path = path
+        self.dir = dir
+        self.stamp = None
+        self.table = {}
+    
+    def load(self):
+        #rereads the table whenever make.py rewrites it
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            self.stamp, self.table = None, {}
+            return
+        if (st.st_mtime, st.st_size) != self.stamp:
+            f = open(self.path, 'r')
+            self.table = json.load(f)
+            f.close()
+            self.stamp = (st.st_mtime, st.st_size)
+    
+    def url(self, url, base='/'):
+        #fingerprinted form of url, which is relative to base. Assets that are
+        #not in the table, or changed since it was written, keep their url.
+        self.load()
+        path = os.path.normpath(os.path.join(base, url)).lstrip('/')
+        entry = self.table.get(path)
+        if not entry: return url
+        try:
+            st = os.stat(path)
+        except OSError:
+            return url
+        if [st.st_mtime, st.st_size] != entry[1:3]: return url
+        return url[:url.rfind('/') + 1] + entry[0]
+
+assets = Assets()
+asset = assets.url
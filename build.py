@@ -1,4 +1,521 @@
+import os
+import re
 import sys
+import subprocess
+import tempfile
+import threading
+from base64 import b64encode
+from collections import OrderedDict
+from hashlib import sha1
+try: import json
+except ImportError: import simplejson as json
+
+YC = 'Extras/yuicompressor-2.4.2.jar'
+
+#process-wide build cache shared by every Build instance.
+#_sources maps a file path to (mtime, size, digest, text) and is only
+#refreshed when the file's mtime or size changes. _builds maps a build
+#config to (key, script, layout, hash), where key is the resolved module list
+#plus the digest of each module, so a cached script is reused until an input
+#changes, and hash is the script's sha1.
+_sources = {}
+_builds = {}
+
+#memoized topological orders, keyed by sources dir, model contents and
+#build config.
+_orders = {}
+
+#scripts published under their sha1 by Build.publish, see published. Only
+#the most recently used are kept in memory, and only so many on disk.
+_published = OrderedDict()
+_published_lock = threading.Lock()
+_published_max = 16
+_bundles_max = 256
+
+class BuildError(Exception): pass
+
+#module dependencies, shared by every Build instance
+build_model = {
+    'AngularWidth': ['Graph'],
+    'Animation': ['Core'],
+    'Canvas': ['Core'],
+    'Complex': ['Polar'],
+    'Core': [],
+    'Graph': ['Core', 'Complex', 'Polar'],
+    'Graph.Op': ['Core', 'Graph'],
+    'Graph.Plot': ['Core', 'Graph'],
+    'Loader': ['Core', 'Graph'],
+    #Polar and Complex reference each other only at runtime,
+    #so only one edge is declared to keep the model acyclic.
+    'Polar': [],
+    
+    'Hypertree': ['Core', 
+                  'Canvas', 
+                  'Complex', 
+                  'Polar', 
+                  'Graph', 
+                  'Graph.Op',
+                  'Graph.Plot',
+                  'AngularWidth',
+                  'Loader', 
+                  'Animation'],
+    
+    'RGraph':     ['Core', 
+                   'Canvas', 
+                   'Complex', 
+                   'Polar', 
+                   'Graph', 
+                   'Graph.Op',
+                   'Graph.Plot',
+                   'AngularWidth',
+                   'Loader', 
+                   'Animation'],
+    
+    'Spacetree':   ['Core', 
+                    'Canvas', 
+                    'Complex',
+                    'Polar', 
+                    'Graph', 
+                    'Graph.Op',
+                    'Graph.Plot',
+                    'Loader', 
+                    'Animation'],
+    
+    'QuadTree':    ['Core'],
+                    
+    'ForceGraph':  ['Core',
+                    'Canvas', 
+                    'Complex',
+                    'Graph',
+                    'Graph.Op',
+                    'Graph.Plot',
+                    'Loader', 
+                    'Animation'],
+                    
+    'Treemap':      ['Core']
+}
+
+#visualizations bundled in the library by default
+library = ['Spacetree', 'RGraph', 'Hypertree', 'Treemap']
+
+def published(hash, path='.build/bundles/'):
+    #script published under hash by this or another process, or None
+    script = _published.get(hash)
+    if script is None:
+        name = path + hash + '.js'
+        if not os.path.isfile(name): return None
+        f = open(name, 'r')
+        script = f.read()
+        f.close()
+    _remember(hash, script)
+    return script
+
+def _remember(hash, script):
+    #marks a published script as the most recently used one
+    _published_lock.acquire()
+    try:
+        _published.pop(hash, None)
+        _published[hash] = script
+        while len(_published) > _published_max: _published.popitem(last=False)
+    finally:
+        _published_lock.release()
+
+def _prune(path):
+    #removes all but the _bundles_max most recently published bundles
+    times = []
+    for name in os.listdir(path):
+        try:
+            if name.endswith('.js'): times.append((os.path.getmtime(path + name), name))
+        except OSError: pass
+    times.sort()
+    for t, name in times[:-_bundles_max]:
+        try: os.remove(path + name)
+        except OSError: pass
+
+def _write(name, text):
+    #writes a file other threads and processes may be reading or writing:
+    #to a temporary file of its own first, then renamed over name, so
+    #readers see all of it or nothing
+    fd, tmp = tempfile.mkstemp('.tmp', os.path.basename(name) + '.', os.path.dirname(name))
+    f = os.fdopen(fd, 'w')
+    f.write(text)
+    f.close()
+    os.chmod(tmp, 0644)
+    os.rename(tmp, name)
+
+def _makedirs(path):
+    #os.makedirs, fine with another thread or process creating path first
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path): raise
+
+def _source(path):
+    st = os.stat(path)
+    entry = _sources.get(path)
+    if not entry or entry[:2] != (st.st_mtime, st.st_size):
+        f = open(path, 'r')
+        text = f.read()
+        f.close()
+        entry = (st.st_mtime, st.st_size, sha1(text).hexdigest(), text)
+        _sources[path] = entry
+    return entry
+
+#javascript minifier. tokenize() splits a script into significant tokens,
+#telling regex literals from divisions by the token that precedes them (a
+#slash after a word, a number or a closing bracket divides, except after
+#the } of a block or the ) of an if, for, while or with condition), and
+#minify() joins them back keeping only the whitespace the grammar needs:
+#a space between words or between operators that would otherwise fuse, and
+#a newline wherever automatic semicolon insertion could depend on it.
+#Comments are dropped except for /*! ... */ blocks.
+_spaces = re.compile(r'[ \t\r\n\f\v]+')
+_comment = re.compile(r'//[^\n]*|/\*.*?\*/', re.S)
+_string = re.compile(r'"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\'', re.S)
+_number = re.compile(r'0[xX][0-9a-fA-F]+|(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?')
+_word = re.compile(r'[A-Za-z_$\x80-\xff][\w$\x80-\xff]*')
+_regex = re.compile(r'/(?:[^/\\\[\n]|\\.|\[(?:[^\]\\\n]|\\.)*\])+/[A-Za-z]*')
+_punct = re.compile(r'>>>=|===|!==|>>>|<<=|>>=|[=!<>&|+\-*/%^]=|&&|\|\||\+\+|--|<<|>>'
+                    r'|[{}()\[\];,.<>+\-*/%&|^!~?:=]')
+
+#words after which a slash starts a regex literal rather than a division
+_regex_after = set(['return', 'typeof', 'instanceof', 'in', 'new', 'delete',
+                    'void', 'throw', 'case', 'do', 'else'])
+#words whose parenthesized condition is followed by a statement
+_conditions = set(['if', 'for', 'while', 'with'])
+#statements a line break terminates, see ECMA-262 7.9.1
+_restricted = set(['return', 'break', 'continue', 'throw'])
+#punctuators that may end an expression, and that may start one. A line
+#break is only kept between a token of the first kind and one of the second.
+_ends = set([')', ']', '}', '++', '--'])
+_starts = set(['(', '[', '{', '++', '--', '!', '~', '+', '-'])
+_ident = re.compile(r'[\w$\x80-\xff]')
+
+def tokenize(text):
+    #yields (kind, value, line, col, newline, pos) for every significant
+    #token, where line and col are 0-based, newline tells whether a line
+    #break separates it from the previous token and pos is its offset.
+    pos, line, bol, end = 0, 0, 0, len(text)
+    prev, nl = None, False
+    #for each open paren, whether it follows one of _conditions; cond tells
+    #whether prev closes such a paren
+    parens, cond = [], False
+    while pos < end:
+        kind = None
+        m = _spaces.match(text, pos)
+        if m: pass
+        elif text.startswith('/*!', pos):
+            m, kind = _comment.match(text, pos), 'comment'
+        elif text[pos] == '/' and text[pos + 1:pos + 2] in ('/', '*'):
+            m = _comment.match(text, pos)
+        else:
+            c = text[pos]
+            if c in '"\'':
+                m, kind = _string.match(text, pos), 'string'
+            elif c == '/' and (prev is None or prev[0] == 'word' and prev[1] in _regex_after
+                               or prev[0] == 'punct' and (prev[1] not in _ends
+                                                          or prev[1] == '}' or cond)):
+                m, kind = _regex.match(text, pos), 'regex'
+            elif c.isdigit() or c == '.' and text[pos + 1:pos + 2].isdigit():
+                m, kind = _number.match(text, pos), 'number'
+            elif _word.match(text, pos):
+                m, kind = _word.match(text, pos), 'word'
+            else:
+                m, kind = _punct.match(text, pos), 'punct'
+        if not m:
+            raise BuildError('unexpected %r at line %d' % (text[pos:pos + 10], line + 1))
+        value = m.group()
+        if kind:
+            token = (kind, value, line, pos - bol, nl, pos)
+            if kind != 'comment':
+                cond = False
+                if kind == 'punct' and value == '(':
+                    parens.append(prev is not None and prev[0] == 'word' and prev[1] in _conditions)
+                elif kind == 'punct' and value == ')' and parens:
+                    cond = parens.pop()
+                prev = token
+            nl = False
+            yield token
+        lines = value.count('\n')
+        if lines:
+            line += lines
+            bol = pos + value.rindex('\n') + 1
+            nl = nl or not kind
+        pos = m.end()
+
+def separator(prev, token):
+    #whitespace needed between two tokens, '' when they can be joined
+    a, b = prev[1], token[1]
+    if token[4]:
+        if prev[0] == 'comment' or token[0] == 'comment': return '\n'
+        if prev[0] == 'word' and a in _restricted or b in ('++', '--'): return '\n'
+        if (prev[0] != 'punct' or a in _ends) and (token[0] != 'punct' or b in _starts):
+            return '\n'
+    if _ident.match(a[-1]) and _ident.match(b[0]): return ' '
+    if a[-1] in '+-' and b[0] == a[-1]: return ' '
+    if a[-1] == '/' and b[0] in '/*': return ' '
+    if prev[0] == 'number' and b[0] == '.' and a.isdigit(): return ' '
+    if a[-1] == '<' and b[0] == '!' or a[-2:] == '--' and b[0] == '>': return ' '
+    return ''
+
+def minify(text, segments=None):
+    #when a segments list is given, (line, col, source line, source col) is
+    #appended to it for every token, line and col being 0-based in the output
+    out, prev, line, col = [], None, 0, 0
+    for token in tokenize(text):
+        if prev:
+            sep = separator(prev, token)
+            out.append(sep)
+            if sep == '\n': line, col = line + 1, 0
+            else: col += len(sep)
+        if segments is not None: segments.append((line, col, token[2], token[3]))
+        out.append(token[1])
+        lines = token[1].count('\n')
+        if lines: line, col = line + lines, len(token[1]) - token[1].rindex('\n') - 1
+        else: col += len(token[1])
+        prev = token
+    return ''.join(out)
+
+#tree shaking. Module sources are split into top-level statements, looking
+#into the body of top-level (function () { ... })() wrappers as well. A
+#statement that defines a name (function declarations, var statements and
+#assignments to a dotted name such as Graph.Util or ST.Op) is dropped unless
+#something kept references it; every other statement is kept. A dotted name
+#that is used as a value rather than called or dereferenced, e.g. aliased
+#(GUtil = Graph.Util) or indexed (Trans[key]), keeps everything defined
+#under it, and X.prototype.* definitions are kept along with X.
+_continues = set(['else', 'catch', 'finally', 'while', 'in', 'instanceof'])
+
+def _statements(tokens, start, end):
+    #(first, last) token index pairs for the statements in tokens[start:end],
+    #last being inclusive. Statements end at a ; or a function declaration's
+    #closing brace, or at a line break between a complete expression and a
+    #word that starts a new statement.
+    stmts, depth, first = [], 0, start
+    for i in range(start, end):
+        kind, value = tokens[i][:2]
+        if kind == 'punct' and value in '{([': depth += 1
+        elif kind == 'punct' and value in '})]': depth -= 1
+        if depth: continue
+        nxt = i + 1 < end and tokens[i + 1] or None
+        if (kind == 'punct' and value == ';'
+            or kind == 'comment'
+            or value == '}' and tokens[first][1] == 'function'
+            or nxt and nxt[4] and nxt[0] == 'word' and nxt[1] not in _continues
+               and value not in (')', 'else', 'do') and separator(tokens[i], nxt) == '\n'
+            or not nxt):
+            stmts.append((first, i))
+            first = i + 1
+    return stmts
+
+def _chains(tokens, start, end, skip=()):
+    #(refs, escapes) for the dotted names used in tokens[start:end]. refs
+    #holds every name and its prefixes, escapes the names used as values.
+    refs, escapes, i = set(), set(), start
+    while i < end:
+        if tokens[i][0] != 'word' or i in skip or i > start and tokens[i - 1][1] == '.':
+            i += 1
+            continue
+        parts = [tokens[i][1]]
+        while i + 2 < end and tokens[i + 1][1] == '.' and tokens[i + 2][0] == 'word':
+            parts.append(tokens[i + 2][1])
+            i += 2
+        if parts[0] == 'this' and len(parts) > 1: parts = parts[1:]
+        for k in range(len(parts)): refs.add('.'.join(parts[:k + 1]))
+        nxt = i + 1 < end and tokens[i + 1][1] or ''
+        key = len(parts) == 1 and nxt == ':' and tokens[i - 1][1] in ('{', ',')
+        if nxt not in ('(', '.') and not key: escapes.add('.'.join(parts))
+        i += 1
+    return refs, escapes
+
+def _definition(tokens, first, last):
+    #(names, target token indexes) defined by a statement, or None. Empty
+    #statements define nothing, so they are always dropped.
+    t = [tok[1] for tok in tokens[first:last + 1]]
+    kinds = [tok[0] for tok in tokens[first:last + 1]]
+    if t == [';']: return [], set()
+    if len(t) > 2 and t[0] == 'function' and kinds[1] == 'word':
+        return [t[1]], set([first + 1])
+    if t[0] == 'var':
+        names, targets, depth = [], set(), 0
+        for k in range(1, len(t)):
+            if kinds[k] == 'punct' and t[k] in '{([': depth += 1
+            elif kinds[k] == 'punct' and t[k] in '})]': depth -= 1
+            elif not depth and kinds[k] == 'word' and t[k - 1] in ('var', ','):
+                names.append(t[k])
+                targets.add(first + k)
+        return names, targets
+    k = 0
+    if t[0] == 'this' and len(t) > 2 and t[1] == '.': k = 2
+    if kinds[k] != 'word': return None
+    while k + 2 < len(t) and t[k + 1] == '.' and kinds[k + 2] == 'word': k += 2
+    name = [t[j] for j in range(0, k + 1, 2) if t[j] != 'this']
+    if k > 0 and name[-1] == 'implement' and t[k + 1:k + 2] == ['(']:
+        #Class mixins only matter if the class is kept
+        return ['.'.join(name[:-1])], set(range(first, first + k + 1))
+    if k + 1 >= len(t) or t[k + 1] != '=': return None
+    depth = 0
+    for j in range(k + 2, len(t)):
+        if kinds[j] == 'punct' and t[j] in '{([': depth += 1
+        elif kinds[j] == 'punct' and t[j] in '})]': depth -= 1
+        elif not depth and t[j] == '=': return None
+    return ['.'.join(name)], set(range(first, first + k + 1))
+
+def _units(tokens, start, end):
+    #statements, descending into top-level function wrappers
+    ans = []
+    for first, last in _statements(tokens, start, end):
+        if tokens[first][1] == '(' and first + 1 <= last and tokens[first + 1][1] == 'function':
+            j = first + 2
+            while j <= last and tokens[j][1] != '{': j += 1
+            depth, k = 0, j
+            while k <= last:
+                if tokens[k][0] == 'punct' and tokens[k][1] in '{([': depth += 1
+                elif tokens[k][0] == 'punct' and tokens[k][1] in '})]': depth -= 1
+                if not depth: break
+                k += 1
+            ans.append((first, j, None))
+            ans += _units(tokens, j + 1, k)
+            ans.append((k, last, None))
+        else:
+            ans.append((first, last, _definition(tokens, first, last)))
+    return ans
+
+def shake(texts, roots):
+    #drops the definitions in texts (module sources) that neither roots
+    #(scripts using the library) nor kept code reference. Dropped statements
+    #are blanked out, keeping their line breaks, so the remaining code keeps
+    #its lines and columns.
+    refs, escapes, defs, modules = set(), set(), [], []
+    for text in roots:
+        tokens = list(tokenize(text))
+        r, e = _chains(tokens, 0, len(tokens))
+        refs |= r
+        escapes |= e
+    for text in texts:
+        tokens = [t for t in tokenize(text) if t[0] != 'comment']
+        modules.append((text, tokens))
+        for first, last, definition in _units(tokens, 0, len(tokens)):
+            if definition:
+                names, targets = definition
+                r, e = _chains(tokens, first, last + 1, targets)
+                defs.append([names, r, e, False, len(modules) - 1, first, last])
+            else:
+                r, e = _chains(tokens, first, last + 1)
+                refs |= r
+                escapes |= e
+    
+    def reachable(name):
+        parts = name.split('.')
+        for k in range(1, len(parts)):
+            prefix = '.'.join(parts[:k])
+            if prefix in escapes or parts[k] == 'prototype' and prefix in refs: return True
+        return name in refs
+    
+    changed = True
+    while changed:
+        changed = False
+        for d in defs:
+            if not d[3] and [n for n in d[0] if reachable(n)]:
+                d[3] = changed = True
+                refs |= d[1]
+                escapes |= d[2]
+                for n in d[0]:
+                    parts = n.split('.')
+                    for k in range(1, len(parts)): refs.add('.'.join(parts[:k]))
+    
+    dropped = [[] for m in modules]
+    for names, r, e, kept, m, first, last in defs:
+        if not kept: dropped[m].append((first, last))
+    ans = []
+    for (text, tokens), spans in zip(modules, dropped):
+        out, pos = [], 0
+        for first, last in spans:
+            begin, end = tokens[first][5], tokens[last][5] + len(tokens[last][1])
+            gap = text[begin:end]
+            out.append(text[pos:begin])
+            out.append('\n' * gap.count('\n') + ' ' * (len(gap) - gap.rfind('\n') - 1))
+            pos = end
+        out.append(text[pos:])
+        ans.append(''.join(out))
+    return ans
+
+def yuicompress(text, segments=None):
+    p = subprocess.Popen(['java', '-jar', YC, '--type', 'js'],
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out = p.communicate(text)[0]
+    if p.returncode:
+        raise BuildError('yuicompressor exited with status %d' % p.returncode)
+    return out
+
+#processing stages that can be applied per module, see Build.build.
+#Each takes the module source and an optional list to record source map
+#segments in, like minify does.
+stages = {
+    'min': minify,
+    'yc': yuicompress,
+}
+
+_base64 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
+def _vlq(n):
+    n = n < 0 and (-n << 1) | 1 or n << 1
+    out = ''
+    while True:
+        digit, n = n & 31, n >> 5
+        if n: digit |= 32
+        out += _base64[digit]
+        if not n: return out
+
+def _mappings(segments):
+    #encodes sorted (line, col, source, source line, source col) segments
+    #as the mappings field of a v3 source map
+    out, current, line, col, last = [], [], 0, 0, (0, 0, 0)
+    for gline, gcol, src, sline, scol in segments:
+        while line < gline:
+            out.append(','.join(current))
+            current, line, col = [], line + 1, 0
+        current.append(_vlq(gcol - col) + _vlq(src - last[0])
+                       + _vlq(sline - last[1]) + _vlq(scol - last[2]))
+        col, last = gcol, (src, sline, scol)
+    out.append(','.join(current))
+    return ';'.join(out)
+
+class Fragments:
+    #on-disk store of processed modules. Fragments are stored as
+    #<module>.<stage>.<digest>.js, next to a .map file holding the source
+    #map segments the stage recorded, so a module is only reprocessed when
+    #its source changes. Fragments of other digests for the same module and
+    #stage are removed when a new one is written.
+    def __init__(self, path='.build/'):
+        self.path = path
+    
+    def get(self, module, stage, digest, source):
+        prefix = module + '.' + stage + '.'
+        name = self.path + prefix + digest
+        if os.path.isfile(name + '.js') and os.path.isfile(name + '.map'):
+            return self.read(name + '.js'), json.loads(self.read(name + '.map'))
+        
+        segments = []
+        text = stages[stage](source, segments)
+        _makedirs(self.path)
+        for old in os.listdir(self.path):
+            #other digests of this fragment, but not the temporary files
+            #of concurrent writes
+            rest = old[len(prefix):]
+            if old.startswith(prefix) and rest.count('.') == 1 and \
+               rest.endswith(('.js', '.map')) and not rest.startswith(digest + '.'):
+                try: os.remove(self.path + old)
+                except OSError: pass
+        _write(name + '.map', json.dumps(segments))
+        _write(name + '.js', text)
+        return text, segments
+    
+    def read(self, name):
+        f = open(name, 'r')
+        text = f.read()
+        f.close()
+        return text
 
 #build model
 class Build():
@@ -9,79 +526,152 @@ class Build():
         
         self.script = ''
         
-        self.build_model = {
-            'AngularWidth': ['Graph'],
-            'Animation': ['Core'],
-            'Canvas': ['Core'],
-            'Complex': ['Polar'],
-            'Core': [],
-            'Graph': ['Core', 'Complex', 'Polar'],
-            'Graph.Op': ['Core', 'Graph'],
-            'Graph.Plot': ['Core', 'Graph'],
-            'Loader': ['Core', 'Graph'],
-            'Polar': ['Complex'],
-            
-            'Hypertree': ['Core', 
-                          'Canvas', 
-                          'Complex', 
-                          'Polar', 
-                          'Graph', 
-                          'Graph.Op',
-                          'Graph.Plot',
-                          'AngularWidth',
-                          'Loader', 
-                          'Animation'],
-            
-            'RGraph':     ['Core', 
-                           'Canvas', 
-                           'Complex', 
-                           'Polar', 
-                           'Graph', 
-                           'Graph.Op',
-                           'Graph.Plot',
-                           'AngularWidth',
-                           'Loader', 
-                           'Animation'],
-            
-            'Spacetree':   ['Core', 
-                            'Canvas', 
-                            'Complex',
-                            'Polar', 
-                            'Graph', 
-                            'Graph.Op',
-                            'Graph.Plot',
-                            'Loader', 
-                            'Animation'],
-            
-            'QuadTree':    ['Core'],
-                            
-            'ForceGraph':  ['Core',
-                            'Canvas', 
-                            'Complex',
-                            'Graph',
-                            'Graph.Op',
-                            'Graph.Plot',
-                            'Loader', 
-                            'Animation'],
-                            
-            'Treemap':      ['Core']
-        }
+        #sha1 of self.script, for publish
+        self.hash = None
+        
+        #(module, first line, line count, segments) for each module in
+        #self.script, see source_map
+        self.layout = []
+        
+        self.build_model = build_model
+        
+        self.fragments = Fragments()
         
-    def build(self, args=['Spacetree', 'RGraph', 'Hypertree', 'Treemap']):
-        self.script = ''.join([self.load_script(viz) for viz in args if viz in self.build_model])
-        self.script = '(function () { \n\n' + self.script + '\n\n })();'
+    def build(self, args=library, stage=None, roots=None):
+        #when a stage is given each module is run through stages[stage]
+        #and the bundle is linked from the stored fragments. roots are the
+        #paths of the scripts using the build; when given, the definitions
+        #they don't need are left out, see shake.
+        roots = tuple(roots or ())
+        config = tuple([viz for viz in args if viz in self.build_model])
+        modules = self.resolve(config)
+        config = (self.sources, stage, config, roots)
+        key = tuple([(m, self.digest(m)) for m in modules] + [(r, _source(r)[2]) for r in roots])
+        cached = _builds.get(config)
+        if cached and cached[0] == key:
+            self.script, self.layout, self.hash = cached[1:]
+        else:
+            self.included = modules
+            shaken = [None] * len(modules)
+            if roots:
+                shaken = shake([_source(self.sources + m + '.js')[3] for m in modules],
+                               [_source(r)[3] for r in roots])
+            head = '(function () { \n\n'
+            parts, self.layout, line = [], [], head.count('\n')
+            for m, source in zip(modules, shaken):
+                text, segments = self.load_fragment(m, stage, source)
+                lines = text.count('\n')
+                #raw modules are followed by two line breaks
+                self.layout.append((m, line, lines - 1, segments))
+                parts.append(text)
+                line += lines
+            self.script = head + ''.join(parts) + '\n\n })();'
+            self.hash = sha1(self.script).hexdigest()
+            _builds[config] = (key, self.script, self.layout, self.hash)
         return self.script
     
-    def load_script(self, script=None):
-        ans = ''
-        if script and not (script in self.included):
-            self.included.append(script)
-            ans = ''.join([self.load_script(s) for s in self.build_model[script]])
-            f = open(self.sources + script + '.js', 'r')
-            ans += f.read() + '\n\n'
-            f.close()
-        
-        return ans
+    def source_map(self, file='', root='', content=True):
+        #v3 source map for the last build. Raw modules are mapped line by
+        #line, staged modules by the segments their stage recorded, or by
+        #their first line when it records none (e.g. yc).
+        segments = []
+        for i, (m, first, lines, recorded) in enumerate(self.layout):
+            if recorded is None:
+                segments += [(first + l, 0, i, l, 0) for l in range(lines)]
+            elif recorded:
+                segments += [(first + l, c, i, sl, sc) for l, c, sl, sc in recorded]
+            else:
+                segments.append((first, 0, i, 0, 0))
+        paths = [self.sources + m + '.js' for m, first, lines, recorded in self.layout]
+        ans = {
+            'version': 3,
+            'file': file,
+            'sourceRoot': root,
+            'sources': paths,
+            'names': [],
+            'mappings': _mappings(segments)
+        }
+        if content: ans['sourcesContent'] = [_source(p)[3] for p in paths]
+        return json.dumps(ans)
+    
+    def inline_map(self, file=''):
+        #comment embedding source_map() in the last build, for serving it inline
+        return ('\n//# sourceURL=' + file + '\n//# sourceMappingURL=data:application/json;base64,'
+                + b64encode(self.source_map(file)))
+    
+    def publish(self, script=None, path='.build/bundles/'):
+        #makes script (the last build by default) available to published()
+        #under its sha1, which is returned. Scripts are written to path too,
+        #so that every process serving the library can find them, and the
+        #least recently published are removed from there.
+        if script is None: script = self.script
+        if script is self.script and self.hash: hash = self.hash
+        else: hash = sha1(script).hexdigest()
+        if hash not in _published:
+            name = path + hash + '.js'
+            if os.path.isfile(name):
+                os.utime(name, None)
+            else:
+                _makedirs(path)
+                _write(name, script)
+                _prune(path)
+        _remember(hash, script)
+        return hash
+    
+    def resolve(self, args):
+        #topologically sorted list of the modules a build config pulls in,
+        #dependencies first. Unknown modules, missing sources and cycles
+        #raise a BuildError before anything is read.
+        model = tuple(sorted([(k, tuple(v)) for k, v in self.build_model.items()]))
+        key = (self.sources, model, tuple(args))
+        modules = _orders.get(key)
+        if modules is None:
+            modules = _orders[key] = self.order(args)
+        #sources can go away after the order was memoized
+        for script in modules:
+            path = self.sources + script + '.js'
+            if not os.path.isfile(path):
+                raise BuildError('missing source for module ' + script + ': ' + path)
+        return modules
+    
+    def order(self, args):
+        #dependencies first walk of the model, see resolve
+        modules, done, visiting = [], set(), []
+        def walk(script):
+            if script in done: return
+            if script in visiting:
+                cycle = visiting[visiting.index(script):] + [script]
+                raise BuildError('dependency cycle: ' + ' -> '.join(cycle))
+            if script not in self.build_model:
+                raise BuildError('unknown module: ' + script)
+            visiting.append(script)
+            for s in self.build_model[script]: walk(s)
+            visiting.pop()
+            done.add(script)
+            modules.append(script)
+        for viz in args: walk(viz)
+        return modules
+    
+    def digest(self, script):
+        return _source(self.sources + script + '.js')[2]
+    
+    def load_script(self, script, stage=None):
+        return self.load_fragment(script, stage)[0]
+    
+    def load_fragment(self, script, stage=None, source=None):
+        #(text, segments) for a module, segments being None for raw sources.
+        #A source given in place of the module's (e.g. shaken) is staged
+        #without going through the fragment store.
+        mtime, size, digest, text = _source(self.sources + script + '.js')
+        if source is not None and stage:
+            segments = []
+            return stages[stage](source, segments) + '\n', segments
+        if source is not None:
+            return source + '\n\n', None
+        if stage:
+            text, segments = self.fragments.get(script, stage, digest, text)
+            return text + '\n', segments
+        return text + '\n\n', None
 
 def main():
     ans = Build().build(sys.argv)
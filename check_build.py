@@ -0,0 +1,153 @@
+#checks for the minifier and the tree shaker in build.py, whose mistakes
+#would silently break the shipped library or the shaken test bundles.
+#Small cases cover the spots where a wrong token break or statement split
+#changes a script. Then every Source/*.js module is minified and checked
+#to hold the same tokens, to minify to itself again and, when node is
+#installed, to parse, as are the minified library and the shaken bundle of
+#every test page.
+#
+#   python check_build.py
+
+import os
+import sys
+import subprocess
+import tempfile
+from build import Build, tokenize, minify, shake, library
+from tests import tests_model
+
+#(source, minified)
+minify_cases = [
+    #a slash divides after a closing paren or bracket, a word or a number
+    ('a = (b) / 2 / c', 'a=(b)/2/c'),
+    ('x = g(a)[0] / 2 / n', 'x=g(a)[0]/2/n'),
+    #and starts a regex after return, the } of a block or a condition
+    ("return /x'y/g.test(s)", "return/x'y/g.test(s)"),
+    ('if (a) {}\n/ x/.test(b)', 'if(a){}\n/ x/.test(b)'),
+    ('if (a) / x/.test(b)', 'if(a)/ x/.test(b)'),
+    ('while (f(a)) / b/.exec(c)', 'while(f(a))/ b/.exec(c)'),
+    ('a = [/ x/, / y/]', 'a=[/ x/,/ y/]'),
+    #line breaks automatic semicolon insertion depends on are kept
+    ('a\n++b', 'a\n++b'),
+    ('a\n--b', 'a\n--b'),
+    ('a++\nb', 'a++\nb'),
+    ('return\na', 'return\na'),
+    ('a = b\n(c)', 'a=b\n(c)'),
+    ('a = 1\nb = 2', 'a=1\nb=2'),
+    ('a = [\n1,\n2\n]', 'a=[1,2]'),
+    #operators that would fuse are kept apart
+    ('a - -b', 'a- -b'),
+    ('a + +b', 'a+ +b'),
+    ('a - --b', 'a- --b'),
+    ('a + ++b', 'a+ ++b'),
+    ('i = 1 .toString()', 'i=1 .toString()'),
+    #comments go, except /*! ones
+    ('x = a /* c */ / b // d', 'x=a/b'),
+    ('/*! keep */\nvar a', '/*! keep */\nvar a'),
+]
+
+shake_library = """var Graph = {};
+Graph.Util = { each: function () {} };
+Graph.Util.extra = function () {};
+Graph.Op = { remove: function () {} };
+Graph.Plot = {};
+Graph.Plot.plot = function () {};
+function unused() { return Graph.Op; }
+var Foo = function () {};
+Foo.prototype.bar = function () {};
+Foo.prototype.baz = 1;
+var Trans = { linear: 1 };
+Trans.Quad = { easeIn: 2 };
+var Other = {};
+Other.x = 1;
+"""
+#a script aliasing Graph.Util, creating a Foo and indexing Trans
+shake_root = "var GUtil = Graph.Util;\nnew Foo();\nTrans[key];"
+shake_kept = ['Graph.Util.extra =', 'Foo.prototype.bar =', 'Foo.prototype.baz =',
+              'Trans.Quad =']
+shake_dropped = ['Graph.Op =', 'Graph.Plot', 'unused', 'Other']
+
+failures = []
+
+def check(ok, what):
+    if not ok:
+        failures.append(what)
+        print 'FAIL', what
+
+def tokens(text):
+    return [t[:2] for t in tokenize(text)]
+
+def parses(name, text):
+    #whether node parses text; True when node isn't installed
+    if not parses.node: return True
+    fd, path = tempfile.mkstemp('.js')
+    os.write(fd, text)
+    os.close(fd)
+    try:
+        p = subprocess.Popen([parses.node, '--check', path],
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out = p.communicate()[0]
+    finally:
+        os.remove(path)
+    if p.returncode: print out
+    return not p.returncode
+
+parses.node = None
+for node in ('node', 'nodejs'):
+    try:
+        subprocess.Popen([node, '--version'], stdout=subprocess.PIPE).communicate()
+        parses.node = node
+        break
+    except OSError: pass
+
+def check_cases():
+    for text, expected in minify_cases:
+        out = minify(text)
+        check(out == expected, 'minify(%r) is %r, not %r' % (text, out, expected))
+        check(parses(text, out), 'minify(%r) does not parse' % text)
+
+    out = shake([shake_library], [shake_root])[0]
+    for name in shake_kept:
+        check(name in out, 'shake dropped %s' % name)
+    for name in shake_dropped:
+        check(name not in out, 'shake kept %s' % name)
+    check(out.count('\n') == shake_library.count('\n') and len(out) == len(shake_library),
+          'shake moved the remaining code')
+
+def check_sources():
+    build = Build()
+    names = sorted([m for m in build.build_model if os.path.isfile(build.sources + m + '.js')])
+    for m in names:
+        text = open(build.sources + m + '.js').read()
+        out = minify(text)
+        check(tokens(out) == tokens(text), 'minify changed the tokens of %s' % m)
+        check(minify(out) == out, 'minify(minify(%s)) differs' % m)
+        check(parses(m, out), 'minified %s does not parse' % m)
+
+    check(parses('library', build.build(library, 'min')), 'minified library does not parse')
+    for viz, tests in sorted(tests_model.items()):
+        for i, model in enumerate(tests):
+            if 'Build' in model: config = model['Build']
+            else: config = [viz]
+            test = 'Tests/%s/test%d.js' % (viz, i + 1)
+            if not os.path.isfile(test): continue
+            roots = ['Tests/js/common.js', test]
+            roots += ['Extras/' + lib for lib in model['Extras'] if lib != 'excanvas.js']
+            modules = build.resolve(config)
+            texts = [open(build.sources + m + '.js').read() for m in modules]
+            shaken = shake(texts, [open(r).read() for r in roots])
+            for m, text, out in zip(modules, texts, shaken):
+                check(out.count('\n') == text.count('\n'),
+                      'shaking %s for %s moved lines' % (m, test))
+            check(parses(test, build.build(config, 'min', roots)),
+                  'shaken bundle for %s does not parse' % test)
+
+def main():
+    if not parses.node: print 'node not found, skipping parse checks'
+    check_cases()
+    check_sources()
+    if failures:
+        print '%d failures' % len(failures)
+        sys.exit(1)
+    print 'ok'
+
+if __name__ == "__main__": main()
@@ -1,20 +1,35 @@
 from os import system, walk
-from shutil import copy
+from glob import glob
+from shutil import copy, rmtree
+from multiprocessing import Pool
+from time import time
+from hashlib import sha1, sha384
+from base64 import b64encode
+import gzip
+import json
+import os
 import sys
 import re
 
 from tests import tests_model
 from serve import render
-from build import Build
+from build import Build, library
+from assets import assets
+from web.httpserver import FINGERPRINTED
 
-YC = 'yuicompressor-2.4.2.jar'
+#compression level of the .gz files served in place of text assets
+GZIP_LEVEL = 9
+COMPRESSIBLE = ('.js', '.css', '.html', '.map', '.json')
+#assets given fingerprinted names, see make_assets
+ASSETS = ['Tests/css/*.css', 'Tests/js/*.js', 'Extras/*.js', 'Extras/*.css', 'Examples/css/*.css']
 
 def main():
     if 'docs' in sys.argv: make_docs()
     if 'examples' in sys.argv: make_examples()
     if 'examples-fancy' in sys.argv: make_examples(fancy=True)
-    if 'build' in sys.argv: make_build()
-    if 'build-fancy' in sys.argv: make_build(fancy=True)
+    stage = 'yc' in sys.argv and 'yc' or 'min'
+    if 'build' in sys.argv: make_build(stage=stage)
+    if 'build-fancy' in sys.argv: make_build(fancy=True, stage=stage)
 
 def make_docs():
     system("perl " 
@@ -23,25 +38,218 @@ def make_docs():
         + "Docs/ -p "
         + "NaturalDocs-1.4 -img NaturalDocs-1.4/img -s docstyle -r")
 
-def make_examples(fancy=False):
-#clean examples folder
-    system("rm -rf Examples/*")
+class Manifest:
+    #records, for each generated file, the inputs it was made from as
+    #path -> [mtime, size, sha1], plus a hash of anything else it depends
+    #on (e.g. its tests_model entry), so that a file is only regenerated
+    #when one of those changes. Inputs are only rehashed when their mtime
+    #or size changes.
+    def __init__(self, path='.build/make.json'):
+        self.path = path
+        self.outputs = {}
+        self.made = set()
+        if os.path.isfile(path):
+            f = open(path, 'r')
+            self.outputs = json.load(f)
+            f.close()
+    
+    def digest(self, path):
+        f = open(path, 'rb')
+        ans = sha1(f.read()).hexdigest()
+        f.close()
+        return ans
+    
+    def stale(self, outputs, inputs, extra=''):
+        self.made.update(outputs)
+        for out in outputs:
+            entry = self.outputs.get(out)
+            if not entry or entry['extra'] != extra or not os.path.isfile(out): return True
+            if sorted(entry['inputs']) != sorted(inputs): return True
+            for path, stamp in entry['inputs'].items():
+                if not os.path.isfile(path): return True
+                st = os.stat(path)
+                if [st.st_mtime, st.st_size] != stamp[:2]:
+                    if self.digest(path) != stamp[2]: return True
+                    stamp[:2] = [st.st_mtime, st.st_size]
+        return False
+    
+    def record(self, outputs, inputs, extra=''):
+        stamps = {}
+        for path in inputs:
+            st = os.stat(path)
+            stamps[path] = [st.st_mtime, st.st_size, self.digest(path)]
+        for out in outputs:
+            self.outputs[out] = {'inputs': stamps, 'extra': extra}
+    
+    def live(self, path):
+        #false for files left over from earlier runs that this one has
+        #not generated (yet), which prune will remove
+        return path not in self.outputs or path in self.made
+    
+    def prune(self, prefix, extra=None):
+        #removes the files under prefix recorded by earlier runs but not
+        #generated by this one, only those recorded with extra if given
+        for out in self.outputs.keys():
+            if extra is not None and self.outputs[out]['extra'] != extra: continue
+            if out.startswith(prefix) and out not in self.made:
+                if os.path.isfile(out): os.remove(out)
+                del self.outputs[out]
+    
+    def save(self):
+        if not os.path.isdir(os.path.dirname(self.path)): os.makedirs(os.path.dirname(self.path))
+        f = open(self.path + '.tmp', 'w')
+        json.dump(self.outputs, f)
+        f.close()
+        os.rename(self.path + '.tmp', self.path)
+
+def copy_file(manifest, src, dst, extra=''):
+    if manifest.stale([dst], [src], extra):
+        if not os.path.isdir(os.path.dirname(dst)): os.makedirs(os.path.dirname(dst))
+        copy(src, dst)
+        manifest.record([dst], [src], extra)
+
+def make_assets(manifest, patterns=ASSETS, path=assets.path, dir=assets.dir):
+    #copies every asset under a name carrying its content hash, e.g.
+    #Tests/css/base.css -> .build/assets/Tests/css/base.1a2b3c4d.css, and
+    #writes the table templates resolve asset urls through, see assets.py.
+    #Assets of the generated Examples/ are copied next to themselves so that
+    #the examples keep working from Jit/.
+    table = {}
+    for pattern in patterns:
+        for src in glob(pattern):
+            if FINGERPRINTED.search(src) or not manifest.live(src): continue
+            base, ext = os.path.splitext(os.path.basename(src))
+            name = base + '.' + manifest.digest(src)[:8] + ext
+            if src.startswith('Examples/'): dst = os.path.join(os.path.dirname(src), name)
+            else: dst = os.path.join(dir, os.path.dirname(src), name)
+            copy_file(manifest, src, dst, 'asset')
+            st = os.stat(src)
+            table[src] = [name, st.st_mtime, st.st_size, dst]
+    manifest.prune('', 'asset')
+    if not os.path.isfile(path) or json.load(open(path, 'r')) != table:
+        if not os.path.isdir(os.path.dirname(path)): os.makedirs(os.path.dirname(path))
+        f = open(path, 'w')
+        json.dump(table, f, indent=1, sort_keys=True)
+        f.close()
+    return table
+
+def copy_tree(manifest, src, dst):
+    #.gz files and integrity.json are made per tree, see compress_tree
+    for root, dirs, files in walk(src):
+        for name in files:
+            path = os.path.join(root, name)
+            if not name.endswith('.gz') and name != 'integrity.json' and manifest.live(path):
+                copy_file(manifest, path, dst + path[len(src):])
+
+def compress_file(manifest, path, level=GZIP_LEVEL):
+    #writes a .gz sibling for path, kept only when it is smaller
+    if not manifest.stale([path + '.gz'], [path], str(level)): return
+    f = open(path, 'rb')
+    data = f.read()
+    f.close()
+    tmp = path + '.gz.tmp'
+    f = open(tmp, 'wb')
+    gz = gzip.GzipFile(os.path.basename(path), 'wb', level, f, 0)
+    gz.write(data)
+    gz.close()
+    f.close()
+    if os.path.getsize(tmp) < len(data):
+        os.rename(tmp, path + '.gz')
+        manifest.record([path + '.gz'], [path], str(level))
+    else:
+        os.remove(tmp)
+        if os.path.isfile(path + '.gz'): os.remove(path + '.gz')
+        manifest.made.discard(path + '.gz')
+
+def compress_tree(manifest, root, level=GZIP_LEVEL):
+    #precompresses the text files under root and lists every file with its
+    #size and subresource integrity hash in root/integrity.json
+    for dirpath, dirs, files in walk(root):
+        for name in files:
+            path = os.path.join(dirpath, name)
+            if name.endswith(COMPRESSIBLE) and name != 'integrity.json' and manifest.live(path):
+                compress_file(manifest, path, level)
+    paths = []
+    for dirpath, dirs, files in walk(root):
+        paths += [os.path.join(dirpath, name) for name in files
+                  if name != 'integrity.json' and manifest.live(os.path.join(dirpath, name))]
+    output = os.path.join(root, 'integrity.json')
+    if not manifest.stale([output], paths): return
+    ans = {}
+    for path in paths:
+        f = open(path, 'rb')
+        data = f.read()
+        f.close()
+        ans[path[len(root) + 1:]] = {
+            'size': len(data),
+            'integrity': 'sha384-' + b64encode(sha384(data).digest())
+        }
+    f = open(output, 'w')
+    json.dump(ans, f, indent=1, sort_keys=True)
+    f.close()
+    manifest.record([output], paths)
+
+def example_files(viz, model, i, count, fancy):
+    #(outputs, inputs, extra) for an example, see Manifest
+    strdir = 'Examples/' + viz + '/example' + str(count)
+    test = str(i + 1)
+    outputs = [strdir + '.js', strdir + '.html']
+    inputs = ['Tests/js/common.js', 'Tests/' + viz + '/test' + test + '.js',
+              assets.path, 'Templates/baseexamples.html', 'Templates/' + viz + '/left.html',
+              'Templates/' + viz + '/test' + test + '.html']
+    if fancy:
+        outputs.append(strdir + '.code.html')
+        inputs.append('Templates/basecode.html')
+    extra = sha1(json.dumps([model, i, fancy], sort_keys=True)).hexdigest()
+    return outputs, inputs, extra
+
+def make_examples(fancy=False, processes=None, manifest=None):
+    save = not manifest
+    if save: manifest = Manifest()
+#start from a clean examples folder when there is nothing to compare against
+    if not manifest.outputs and os.path.isdir('Examples'): rmtree('Examples')
 #create example folders
-    system('mkdir Examples/Hypertree Examples/RGraph Examples/Treemap Examples/Spacetree Examples/Other')
+    for viz in ['Hypertree', 'RGraph', 'Treemap', 'Spacetree', 'Other']:
+        if not os.path.isdir('Examples/' + viz): os.makedirs('Examples/' + viz)
 #copy css base files
-    system('cp -r Tests/css Examples/css')
-#iterate over the examples
+    copy_tree(manifest, 'Tests/css', 'Examples/css')
+    if fancy: copy_file(manifest, 'Extras/code.css', 'Examples/css/code.css')
+#fingerprint assets before the pages referencing them are rendered
+    make_assets(manifest)
+#iterate over the examples, keeping the ones that are out of date
+    jobs, files = [], {}
     for viz, tests in tests_model.items():
         count = 1
         for i in range(len(tests)):
             model = tests[i]
             if 'Example' in model and model['Example']:
-                make_example(viz, model, i, count, fancy)
+                files[viz, count] = example_files(viz, model, i, count, fancy)
+                if manifest.stale(*files[viz, count]):
+                    jobs.append((viz, model, i, count, fancy))
                 count += 1
+#render them in a process pool, one process per core by default
+    start = time()
+    if jobs:
+        pool = Pool(processes)
+        for viz, count, elapsed in pool.imap_unordered(timed_example, jobs):
+            manifest.record(*files[viz, count])
+            print "  %s/example%d %.3fs" % (viz, count, elapsed)
+        pool.close()
+        pool.join()
+    print "  %d of %d examples rebuilt in %.3fs" % (len(jobs), len(files), time() - start)
 #copy some extra files
     if fancy:
-        system('cp -r Extras/sh Examples/')
-        system('cp Extras/code.css Examples/css/code.css')
+        copy_tree(manifest, 'Extras/sh', 'Examples/sh')
+#precompress them for the static server
+    compress_tree(manifest, 'Examples')
+#remove files left over from earlier runs
+    manifest.prune('Examples/')
+    if save: manifest.save()
+
+def timed_example(job):
+    start = time()
+    make_example(*job)
+    return job[0], job[3], time() - start
 
 def make_example(viz, ex, i, count, fancy):
     
@@ -95,19 +303,41 @@ def make_example(viz, ex, i, count, fancy):
         fcode.close()
     
 
-def make_build(fancy=False):
-    system('rm -rf Jit/*')
+def make_build(fancy=False, stage='min', level=GZIP_LEVEL):
+    manifest = Manifest()
+    if not manifest.outputs and os.path.isdir('Jit'): rmtree('Jit')
     print "Building Examples..."
-    make_examples(fancy)
-    system('cp -r Examples/ Jit/')
+    make_examples(fancy, manifest=manifest)
+    copy_tree(manifest, 'Examples', 'Jit/Examples')
     print "Done. Building Extras..."
-    system('mkdir Jit/Extras && cp Extras/excanvas.js Jit/Extras/excanvas.js')
+    copy_file(manifest, 'Extras/excanvas.js', 'Jit/Extras/excanvas.js')
+    excanvas = make_assets(manifest)['Extras/excanvas.js']
+    copy_file(manifest, excanvas[3], 'Jit/Extras/' + excanvas[0])
     print "Done. Building Library..."
-    lib = Build().build()
-    f = open('Jit/jit.js', 'w')
-    f.write(lib)
-    f.close()
+    write_build(manifest, Build(), 'jit.js')
     print "Done. Compressing Library..."
-    system('java -jar Extras/' + YC + ' Jit/jit.js > Jit/jit-yc.js')
+    #modules are compressed one by one and cached under .build/,
+    #so only the ones that changed since the last build are recompressed.
+    #'min' is the built-in minifier, 'yc' uses YUI Compressor.
+    write_build(manifest, Build(), 'jit-yc.js', stage)
+    print "Done. Precompressing..."
+    compress_tree(manifest, 'Jit', level)
+    compress_tree(manifest, assets.dir, level)
+    manifest.prune('Jit/')
+    manifest.prune(assets.dir)
+    manifest.save()
     print "Done, I guess."
+
+def write_build(manifest, build, name, stage=None):
+    outputs = ['Jit/' + name, 'Jit/' + name + '.map']
+    inputs = ['build.py'] + [build.sources + m + '.js' for m in build.resolve(library)]
+    if not manifest.stale(outputs, inputs, stage or ''): return
+    lib = build.build(library, stage=stage)
+    f = open('Jit/' + name, 'w')
+    f.write(lib + '\n//# sourceMappingURL=' + name + '.map\n')
+    f.close()
+    f = open('Jit/' + name + '.map', 'w')
+    f.write(build.source_map(name, '../'))
+    f.close()
+    manifest.record(outputs, inputs, stage or '')
 if __name__ == "__main__": main()
@@ -1,16 +1,25 @@
+import sys
+from hashlib import sha1
+from multiprocessing import cpu_count
 import web
 from web import template
 from tests import tests_model
-from build import Build
+from build import Build, published
+from assets import assets, asset
 
 urls = (
     '/testcase/(RGraph|Treemap|Hypertree|Spacetree|Other)/([0-9]+)/', 'testcase',
+    '/build/([0-9a-f]{40})\.js', 'library',
 )
 
 app = web.application(urls, globals())
 
+#compiled templates are kept across restarts (and shared by workers)
+web.config.template_cache_dir = '.build/templates/'
+#fingerprinted asset copies are served from there, see assets.py
+web.config.asset_dir = assets.dir
 render = {
-    'TestCases': template.render('Templates/'),
+    'TestCases': template.render('Templates/', globals={'asset': asset}),
 }
 
 class testcase:
@@ -30,13 +39,56 @@ class testcase:
         if 'Build' in model: build_config = model['Build']
         else: build_config = [type]
 
-        build = Build().build(build_config)
+        #?min serves the library through the built-in minifier,
+        #?map appends an inline source map to it and ?shake leaves out
+        #the parts of the library this test doesn't use
+        params, stage, roots = web.input(), None, None
+        if 'min' in params: stage = 'min'
+        if 'shake' in params:
+            roots = ['Tests/js/common.js', 'Tests/' + type + '/' + test]
+            roots += ['Extras/' + lib for lib in extras if lib != 'excanvas.js']
+        builder = Build()
+        build = builder.build(build_config, stage=stage, roots=roots)
+        if 'map' in params: build += builder.inline_map('jit.js')
+        #the page loads the library from /build/, where browsers can cache it
+        build = '/build/' + builder.publish(build) + '.js'
         
         includes = {
             'left':  getattr(render['TestCases'], type + '/' + 'left')(model, type, number_int, max),
             'right': getattr(render['TestCases'], type + '/' + 'test' + number)(model),
         }
         
-        return render['TestCases'].basetests(name, title, extras, test, build, includes)
+        #pages are tagged with a hash of their content, which covers the
+        #build through its url, so reloads can be answered with a 304
+        page = str(render['TestCases'].basetests(name, title, extras, test, build, includes))
+        etag = sha1(page).hexdigest()
+        web.header('ETag', '"' + etag + '"')
+        if not web.modified(etag=etag): return ''
+        return page
 
-if __name__ == "__main__": app.run()
+class library:
+    def GET(self, hash):
+        script = published(hash)
+        if script is None: raise web.notfound()
+        #bundles are named after their content, so they never change
+        web.header('Content-Type', 'text/javascript')
+        web.header('ETag', '"' + hash + '"')
+        web.header('Cache-Control', 'public, max-age=31536000, immutable')
+        if not web.modified(etag=hash): return ''
+        return script
+
+if __name__ == "__main__":
+    #building and rendering are CPU bound: serve from a process per core
+    web.config.workers = cpu_count()
+    #and let each one add threads while requests queue up
+    web.config.server_autoscale = True
+    #past which requests get a quick 503 rather than a long wait
+    web.config.server_max_queue = 256
+    web.config.server_deadline = 10
+    #have the templates compiled before the workers are forked. In debug
+    #mode requests are handled by this file imported as the serve module
+    #(see web.application), with a render of its own.
+    if web.config.debug: import serve as handler
+    else: handler = sys.modules[__name__]
+    handler.render['TestCases'].preload()
+    app.run(web.GzipMiddleware)
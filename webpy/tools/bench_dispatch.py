@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Benchmark of url dispatch: the time application._match takes per request
+for mappings of 10, 100 and 1000 urls, next to the old loop which tried
+the urls one regular expression at a time.
+
+    python tools/bench_dispatch.py [requests]
+"""
+import os, sys, timeit, urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import web
+from web import utils
+
+def linear_match(mapping, value):
+    """application._match as it was before urls were compiled together."""
+    for pat, what in utils.group(mapping, 2):
+        if isinstance(what, basestring):
+            what, result = utils.re_subm('^' + pat + '$', what, value)
+        else:
+            result = utils.re_compile('^' + pat + '$').match(value)
+        if result:
+            return what, [x and urllib.unquote(x) for x in result.groups()]
+    return None, None
+
+class page:
+    def GET(self, *args): return 'page'
+
+def make_mapping(n):
+    """A mapping of n urls in the shape of a typical application's."""
+    urls = []
+    for i in range(n):
+        kind = i % 3
+        if kind == 0:
+            urls += ['/section%d/' % i, 'page']
+        elif kind == 1:
+            urls += ['/section%d/(\d+)/' % i, 'page']
+        else:
+            urls += ['/section%d/([^/]+)/(\d+)/' % i, page]
+    return tuple(urls)
+
+def bench(n, requests):
+    mapping = make_mapping(n)
+    app = web.application(mapping, globals())
+    paths = {
+        'first': '/section0/',
+        'middle': '/section%d/name/42/' % (n / 2 - (n / 2) % 3 + 2),
+        'last': '/section%d/7/' % (n - 1 - (n - 2) % 3),
+        'miss': '/nowhere/',
+    }
+    for name in ('first', 'middle', 'last', 'miss'):
+        path = paths[name]
+        assert app._match(mapping, path) == linear_match(mapping, path), path
+        compiled = min(timeit.repeat(lambda: app._match(mapping, path),
+                                     number=requests, repeat=3))
+        linear = min(timeit.repeat(lambda: linear_match(mapping, path),
+                                   number=requests, repeat=3))
+        print '%5d urls  %-6s  compiled %7.2f us  linear %8.2f us' % (
+            n, name, compiled / requests * 1e6, linear / requests * 1e6)
+
+if __name__ == "__main__":
+    requests = int((sys.argv[1:] or [2000])[0])
+    for n in (10, 100, 1000):
+        bench(n, requests)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Regression check for load shedding in the built-in server: with one
+worker thread, a queue of one connection and a short deadline, clients
+which are turned away must still read the whole 503 response, with its
+Retry-After header, rather than have their connection reset. Run with
+the connections both polled and not (the default, and always for SSL).
+
+    python tools/check_shed.py [clients]
+"""
+import os, sys, time, socket, threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from web.wsgiserver import CherryPyWSGIServer
+
+def app(environ, start_response):
+    time.sleep(1)
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', '2')])
+    return ['ok']
+
+def request(port, results):
+    """Send one request and record the status line, or the error."""
+    try:
+        s = socket.create_connection(('127.0.0.1', port))
+        s.sendall('GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+        data = ''
+        while True:
+            chunk = s.recv(4096)
+            if not chunk: break
+            data += chunk
+            if data.startswith('HTTP/1.1 200') and data.endswith('ok'): break
+        s.close()
+        results.append(data)
+    except socket.error, e:
+        results.append(e)
+
+def check(poll_idle, clients):
+    server = CherryPyWSGIServer(('127.0.0.1', 0), app, numthreads=1)
+    server.poll_idle = poll_idle
+    server.requests.max_queue = 1
+    server.requests.deadline = 0.5
+    server.listen()
+    port = server.socket.getsockname()[1]
+    t = threading.Thread(target=server.start)
+    t.setDaemon(True)
+    t.start()
+    while not server.ready:
+        time.sleep(0.1)
+
+    results = []
+    threads = [threading.Thread(target=request, args=(port, results))
+               for i in range(clients)]
+    for c in threads: c.start()
+    for c in threads: c.join()
+    server.stop()
+
+    ok = shed = 0
+    for r in results:
+        if isinstance(r, str) and r.startswith('HTTP/1.1 200'):
+            ok += 1
+        elif isinstance(r, str) and r.startswith('HTTP/1.1 503') and \
+        'Retry-After: ' in r and r.endswith('please retry later.'):
+            shed += 1
+    print '%s: %d answered, %d shed, %d failed' % (
+        poll_idle and 'polled' or 'accepted', ok, shed, clients - ok - shed)
+    for r in results:
+        if not isinstance(r, str): print '  ', r
+    return ok + shed == clients and shed > 0
+
+def main(clients):
+    passed = [check(poll_idle, clients) for poll_idle in (False, True)]
+    if not all(passed):
+        print 'FAIL'
+        return 1
+    print 'ok'
+    return 0
+
+if __name__ == "__main__":
+    status = main(int((sys.argv[1:] or [5])[0]))
+    # don't wait for worker threads stuck in the app
+    os._exit(status)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Regression check for the built-in server run by a Supervisor with two
+workers, each polling its idle connections. Both workers may see the
+shared listener readable when a client connects but only one gets the
+connection; the other must go back to its kept-alive connections at once
+rather than wait in accept(). The lost race is checked on its own, then
+requests on kept-alive connections are timed while new clients connect.
+
+    python tools/check_workers.py [rounds]
+"""
+import os, sys, time, signal, socket, httplib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from web.wsgiserver import CherryPyWSGIServer, ConnectionPoller, Supervisor
+
+# a kept-alive request answered slower than this waited on another accept
+MAX_LATENCY = 0.5
+# clients connecting at once in each round
+BURST = 20
+
+def app(environ, start_response):
+    body = str(os.getpid())
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+def check_lost_race(port):
+    """Time accept() on a polled listener another worker has drained."""
+    server = CherryPyWSGIServer(('127.0.0.1', port), app)
+    server.listen()
+    try:
+        # as in a worker's start()
+        ConnectionPoller(server)
+        server.ready = True
+        start = time.time()
+        conn = server.accept()
+        elapsed = time.time() - start
+    finally:
+        server.socket.close()
+    print 'accept() without a connection took %.3fs' % elapsed
+    return conn is None and elapsed < MAX_LATENCY
+
+def serve(port):
+    """Fork a Supervisor running two polling workers on port."""
+    pid = os.fork()
+    if pid:
+        return pid
+    try:
+        server = CherryPyWSGIServer(('127.0.0.1', port), app, numthreads=2)
+        server.poll_idle = True
+        Supervisor(server, 2).start()
+    finally:
+        os._exit(0)
+
+def get(conn):
+    conn.request('GET', '/')
+    response = conn.getresponse()
+    return response.read()
+
+def main(rounds):
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    if not check_lost_race(port):
+        print 'FAIL: over %.1fs' % MAX_LATENCY
+        return 1
+
+    pid = serve(port)
+    try:
+        time.sleep(1)
+        # enough kept-alive connections to have some in both workers
+        conns, workers = [], set()
+        for i in range(8):
+            conn = httplib.HTTPConnection('127.0.0.1', port)
+            workers.add(get(conn))
+            conns.append(conn)
+        if len(workers) < 2:
+            print 'only worker %s took connections' % workers.pop()
+            return 1
+
+        worst = 0
+        for i in range(rounds):
+            clients = [socket.create_connection(('127.0.0.1', port))
+                       for j in range(BURST)]
+            time.sleep(0.05)
+            for conn in conns:
+                start = time.time()
+                get(conn)
+                worst = max(worst, time.time() - start)
+            for client in clients:
+                client.close()
+        print 'slowest kept-alive request %.3fs' % worst
+        if worst > MAX_LATENCY:
+            print 'FAIL: over %.1fs' % MAX_LATENCY
+            return 1
+        print 'ok'
+        return 0
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+if __name__ == "__main__":
+    sys.exit(main(int((sys.argv[1:] or [10])[0])))
@@ -350,15 +350,6 @@ class application:
         ctx.app_stack = []
 
     def _delegate(self, f, fvars, args=[]):
-        def handle_class(cls):
-            meth = web.ctx.method
-            if meth == 'HEAD' and not hasattr(cls, meth):
-                meth = 'GET'
-            if not hasattr(cls, meth):
-                raise web.nomethod(cls)
-            tocall = getattr(cls(), meth)
-            return tocall(*args)
-            
         def is_class(o): return isinstance(o, (types.ClassType, type))
             
         if f is None:
@@ -366,7 +357,7 @@ class application:
         elif isinstance(f, application):
             return f.handle_with_processors()
         elif is_class(f):
-            return handle_class(f)
+            return self._handler(f, fvars)(*args)
         elif isinstance(f, basestring):
             if f.startswith('redirect '):
                 url = f.split(' ', 1)[1]
@@ -375,34 +366,68 @@ class application:
                     if x:
                         url += '?' + x
                 raise web.redirect(url)
-            elif '.' in f:
-                x = f.split('.')
-                mod, cls = '.'.join(x[:-1]), x[-1]
-                mod = __import__(mod, globals(), locals(), [""])
-                cls = getattr(mod, cls)
-            else:
-                cls = fvars[f]
-            return handle_class(cls)
+            return self._handler(f, fvars)(*args)
         elif hasattr(f, '__call__'):
             return f()
         else:
             return web.notfound()
 
+    _handlers = None
+    _handlers_reloads = None
+
+    def _handler(self, f, fvars):
+        """Returns a function calling the method for the current request of
+        the handler class `f`, or of the class named by `f`.
+        
+        Handlers are resolved once and kept until the Reloader reloads
+        a module, so requests don't go through imports and lookups.
+        """
+        if self._handlers_reloads != Reloader.reloads:
+            self._handlers = {}
+            self._handlers_reloads = Reloader.reloads
+        
+        meth = web.ctx.method
+        handler = self._handlers.get((f, meth))
+        if handler is not None:
+            return handler
+        
+        if not isinstance(f, basestring):
+            cls = f
+        elif '.' in f:
+            x = f.split('.')
+            mod, cls = '.'.join(x[:-1]), x[-1]
+            mod = __import__(mod, globals(), locals(), [""])
+            cls = getattr(mod, cls)
+        else:
+            cls = fvars[f]
+        
+        name = meth
+        if name == 'HEAD' and not hasattr(cls, name):
+            name = 'GET'
+        if not hasattr(cls, name):
+            # not remembered: any method could be asked for.
+            raise web.nomethod(cls)
+        def handler(*args):
+            return getattr(cls(), name)(*args)
+        self._handlers[f, meth] = handler
+        return handler
+
+    _routes = None
+    
+    def _router(self, mapping, prefixes=True):
+        """Returns the Router for `mapping`, built again if it has changed."""
+        router = self._routes
+        if router is None or not router.serves(mapping):
+            router = self._routes = Router(mapping, prefixes)
+        return router
+
     def _match(self, mapping, value):
-        for pat, what in utils.group(mapping, 2):
-            if isinstance(what, application):
-                if value.startswith(pat):
-                    f = lambda: self._delegate_sub_application(pat, what)
-                    return f, None
-                else:
-                    continue
-            elif isinstance(what, basestring):
-                what, result = utils.re_subm('^' + pat + '$', what, value)
-            else:
-                result = utils.re_compile('^' + pat + '$').match(value)
-                
-            if result: # it's a match
-                return what, [x and urllib.unquote(x) for x in result.groups()]
+        pat, what, groups = self._router(mapping).match(value)
+        if isinstance(what, application):
+            f = lambda: self._delegate_sub_application(pat, what)
+            return f, None
+        elif pat is not None: # it's a match
+            return what, [x and urllib.unquote(x) for x in groups]
         return None, None
         
     def _delegate_sub_application(self, dir, app):
@@ -513,15 +538,102 @@ class subdomain_application(application):
         return self._delegate(fn, self.fvars, args)
         
     def _match(self, mapping, value):
+        pat, what, groups = self._router(mapping, prefixes=False).match(value)
+        if pat is not None: # it's a match
+            return what, [x and urllib.unquote(x) for x in groups]
+        return None, None
+
+class Router:
+    r"""
+    Matches values against the patterns of a mapping, in order, the way
+    `application._match` does. The patterns are merged into a few large
+    regular expressions, compiled once, so that finding the handler
+    doesn't take a regular expression per url.
+
+        >>> router = Router(("/", "index", "/(\d+)", "view", "/(\w+)/(\d+)", "\\1"))
+        >>> router.match("/42")
+        ('/(\\d+)', 'view', ('42',))
+        >>> router.match("/page/2")
+        ('/(\\w+)/(\\d+)', 'page', ('page', '2'))
+        >>> router.match("/page")
+        (None, None, None)
+
+    With `prefixes`, an application in the mapping handles all values
+    starting with its pattern, as a sub application.
+    """
+    # python's re module can't compile more groups than this.
+    max_groups = 99
+    # what would change meaning when merged with other patterns:
+    # backreferences, named groups and inline flags (which are global).
+    unmergeable = re.compile(r'\\[1-9]|\(\?P|\(\?[iLmsux]')
+
+    def __init__(self, mapping, prefixes=True):
+        self.mapping = mapping
+        self.size = len(mapping)
+        self.routes = []
+        # (regex.match, {wrapping group: (route, groups)}), or the match
+        # or search method and route of a pattern used by itself.
+        self.matchers = []
+        
+        sources, index, ngroups = [], {}, 0
         for pat, what in utils.group(mapping, 2):
-            if isinstance(what, basestring):
-                what, result = utils.re_subm('^' + pat + '$', what, value)
+            route = len(self.routes)
+            self.routes.append((pat, what))
+            if prefixes and isinstance(what, application):
+                source = re.escape(pat)
             else:
-                result = utils.re_compile('^' + pat + '$').match(value)
-
-            if result: # it's a match
-                return what, [x and urllib.unquote(x) for x in result.groups()]
-        return None, None
+                source = '^' + pat + '$'
+            regex = re.compile(source)
+            n = regex.groups
+            
+            # re_subm searches, so in "a|b" the branch without '^'
+            # may match further on in the value.
+            search = isinstance(what, basestring) and '|' in pat
+            if search or self.unmergeable.search(pat) or n >= self.max_groups:
+                self._merge(sources, index)
+                sources, index, ngroups = [], {}, 0
+                self.matchers.append(
+                    (search and regex.search or regex.match, route))
+                continue
+            if ngroups + n + 1 > self.max_groups:
+                self._merge(sources, index)
+                sources, index, ngroups = [], {}, 0
+            # The group around each alternative closes after those in
+            # it, so it is the lastindex of a match.
+            index[ngroups + 1] = (route, n)
+            sources.append('(' + source + ')')
+            ngroups += n + 1
+        self._merge(sources, index)
+
+    def _merge(self, sources, index):
+        if sources:
+            self.matchers.append((re.compile('|'.join(sources)).match, index))
+
+    def serves(self, mapping):
+        """Tells whether this router is (still) up to date for `mapping`."""
+        return mapping is self.mapping and len(mapping) == self.size
+
+    def match(self, value):
+        """Returns the pattern, handler and groups of the first pattern
+        matching `value`, or Nones. Backreferences in a string handler
+        are expanded, as with `utils.re_subm`.
+        """
+        for match, index in self.matchers:
+            m = match(value)
+            if m is None:
+                continue
+            if isinstance(index, dict):
+                route, n = index[m.lastindex]
+                groups = m.groups()[m.lastindex:m.lastindex + n]
+            else:
+                route, groups = index, m.groups()
+            
+            pat, what = self.routes[route]
+            if isinstance(what, basestring) and (
+                '\\' in what or m.span() != (0, len(value))):
+                what = utils.re_subm('^' + pat + '$', what, value)[0]
+            return pat, what, groups
+        return None, None, None
         
 def loadhook(h):
     """
@@ -595,6 +707,10 @@ class Reloader:
     """Checks to see if any loaded modules have changed on disk and, 
     if so, reloads them.
     """
+    # number of reloads so far; what was looked up in modules before
+    # the last one (see application._handler) is out of date.
+    reloads = 0
+
     def __init__(self):
         self.mtimes = {}
 
@@ -616,6 +732,7 @@ class Reloader:
             try: 
                 reload(mod)
                 self.mtimes[mod] = mtime
+                Reloader.reloads += 1
             except ImportError: 
                 pass
 
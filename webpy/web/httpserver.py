@@ -1,10 +1,404 @@
-__all__ = ["runsimple"]
+__all__ = ["runsimple", "GzipMiddleware"]
 
-import sys, os
+import sys, os, re, calendar, time, datetime, threading, gzip, zlib
+from collections import OrderedDict
+from cStringIO import StringIO
 import webapi as web
 import net
 import utils
 
+# names carrying a content hash, e.g. base.1a2b3c4d.css, never change and
+# can be cached forever
+FINGERPRINTED = re.compile(r'\.[0-9a-f]{8}\.\w+$')
+IMMUTABLE = ('Cache-Control', 'public, max-age=31536000, immutable')
+
+def cache_control(path):
+    """
+    The caching headers sent with static file `path`.
+
+        >>> cache_control('/Tests/css/base.1a2b3c4d.css')
+        [('Cache-Control', 'public, max-age=31536000, immutable')]
+        >>> cache_control('/Tests/css/base.css')
+        []
+    """
+    if FINGERPRINTED.search(path):
+        return [IMMUTABLE]
+    return []
+
+def accepts(environ, coding):
+    """
+    Tells whether the `Accept-Encoding` header of a WSGI `environ`
+    allows `coding`.
+
+        >>> accepts({'HTTP_ACCEPT_ENCODING': 'gzip, deflate'}, 'gzip')
+        True
+        >>> accepts({'HTTP_ACCEPT_ENCODING': 'gzip;q=0, *'}, 'gzip')
+        False
+        >>> accepts({}, 'gzip')
+        False
+    """
+    qualities = {}
+    for item in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        parts = item.strip().split(';')
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try: q = float(value)
+                except ValueError: q = 0.0
+        qualities[parts[0].strip().lower()] = q
+    return qualities.get(coding, qualities.get('*', 0.0)) > 0
+
+class StaticCache:
+    """
+    A thread safe LRU cache of small static files, holding at most
+    `max_bytes` of response bodies. Files over `max_file` bytes are never
+    cached. Entries keep the response headers of the file and a gzipped 
+    body when there is an up to date `.gz` sibling or, with `compress`, 
+    when gzip makes a text file smaller. A cached file is stat'ed again 
+    at most every `interval` seconds.
+
+        >>> cache = StaticCache()
+        >>> cache.get('/no/such/file', lambda path: 'text/plain') is None
+        True
+        >>> cache.hits, cache.misses
+        (0, 1)
+    """
+    compressible = ('text/', 'application/javascript', 'application/x-javascript')
+
+    def __init__(self, max_bytes=4 << 20, max_file=256 << 10, interval=2.0, compress=True):
+        self.max_bytes = max_bytes
+        self.max_file = max_file
+        self.interval = interval
+        self.compress = compress
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, path, guess_type):
+        """
+        Returns the entry of file `path`, loading it on a miss, or None
+        when the file can't be cached. `guess_type` gives the mime type 
+        of a path.
+        """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(path, None)
+            if entry:
+                self.entries[path] = entry # most recently used goes last
+        finally:
+            self.lock.release()
+
+        if entry and (now - entry.checked < self.interval or self.fresh(entry)):
+            entry.checked = now
+            self.count(hit=True)
+            return entry
+        self.count(hit=False)
+
+        new = self.load(path, guess_type)
+        self.lock.acquire()
+        try:
+            if entry and self.entries.get(path) is entry:
+                del self.entries[path]
+                self.size -= entry.bytes
+            if new and path not in self.entries:
+                self.entries[path] = new
+                self.size += new.bytes
+                while self.size > self.max_bytes:
+                    key, old = self.entries.popitem(last=False)
+                    self.size -= old.bytes
+        finally:
+            self.lock.release()
+        return new
+
+    def count(self, hit):
+        self.lock.acquire()
+        if hit: self.hits += 1
+        else: self.misses += 1
+        self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        self.entries.clear()
+        self.size = 0
+        self.lock.release()
+
+    def stamp(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+
+    def fresh(self, entry):
+        return self.stamp(entry.path) == entry.stamp and \
+            self.stamp(entry.path + '.gz') == entry.gzstamp
+
+    def load(self, path, guess_type):
+        stamp, gzstamp = self.stamp(path), self.stamp(path + '.gz')
+        if stamp is None or stamp[1] > self.max_file or not os.path.isfile(path):
+            return None
+        try:
+            body = open(path, 'rb').read()
+        except IOError:
+            return None
+
+        mtime = stamp[0]
+        type = guess_type(path)
+        gzbody, gzetag = None, None
+        if gzstamp and gzstamp[0] >= mtime:
+            try:
+                gzbody = open(path + '.gz', 'rb').read()
+                gzetag = '"%x-%x-gz"' % (int(gzstamp[0]), len(gzbody))
+            except IOError:
+                gzbody = None
+        elif self.compress and type.startswith(self.compressible):
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb', mtime=mtime)
+            f.write(body)
+            f.close()
+            if buf.tell() < len(body):
+                gzbody = buf.getvalue()
+                gzetag = '"%x-%x-gz"' % (int(mtime), len(gzbody))
+
+        # headers are computed here once, in the order StaticApp sends them
+        modified = net.httpdate(datetime.datetime.utcfromtimestamp(mtime))
+        def variant(body, etag, coding):
+            headers = [('Content-type', type)]
+            if coding:
+                headers.append(('Content-Encoding', coding))
+            headers.append(('Content-Length', str(len(body))))
+            validators = []
+            if gzbody is not None or gzstamp:
+                validators.append(('Vary', 'Accept-Encoding'))
+            validators += [('ETag', etag), ('Last-Modified', modified)]
+            validators += cache_control(path)
+            return utils.storage(body=body, etag=etag,
+                headers=headers + validators, validators=validators)
+
+        plain = variant(body, '"%x-%x"' % (int(mtime), len(body)), None)
+        gz = gzbody is not None and variant(gzbody, gzetag, 'gzip') or None
+        return utils.storage(path=path, stamp=stamp, gzstamp=gzstamp, 
+            mtime=mtime, checked=time.time(), plain=plain, gzip=gz,
+            bytes=len(body) + len(gzbody or ''))
+
+static_cache = StaticCache()
+
+def gzip_etag(etag):
+    """
+    The entity tag of the gzipped variant of a response tagged `etag`.
+
+        >>> gzip_etag('"1a2b"'), gzip_etag('W/"1a2b"')
+        ('"1a2b-gz"', 'W/"1a2b-gz"')
+    """
+    return etag[:-1] + '-gz"'
+
+class GzipMiddleware:
+    """
+    WSGI middleware gzipping the responses of `app` for clients whose
+    `Accept-Encoding` allows it. A response that is a file wrapper is 
+    swapped for the up to date `.gz` sibling of its file if there is one.
+    Responses with a strong `ETag` are compressed once and kept, up to 
+    `max_bytes`, in an LRU cache. Anything else is compressed as it 
+    streams out.
+
+    Only successful responses of `compressible` types are touched, and 
+    they get a `Vary: Accept-Encoding` header whether compressed or not.
+    Gzipped responses are tagged with `gzip_etag` of the app's tag and 
+    requests validating that tag are passed on to the app with the plain 
+    tag added, so that the app can still answer 304 Not Modified.
+
+        >>> def app(env, start_response):
+        ...     start_response('200 OK', [('Content-Type', 'text/html'), ('ETag', '"42"')])
+        ...     return ['<p>hello</p>' * 100]
+        >>> app = GzipMiddleware(app)
+        >>> def start_response(status, headers): print status, sorted(headers)
+        >>> body = ''.join(app({'HTTP_ACCEPT_ENCODING': 'gzip'}, start_response))
+        200 OK [('Content-Encoding', 'gzip'), ('Content-Type', 'text/html'), ('ETag', '"42-gz"'), ('Vary', 'Accept-Encoding')]
+        >>> zlib.decompress(body, 16 + zlib.MAX_WBITS) == '<p>hello</p>' * 100
+        True
+        >>> body == ''.join(app({'HTTP_ACCEPT_ENCODING': 'gzip'}, lambda *a: None))
+        True
+        >>> app.hits, app.misses
+        (1, 1)
+    """
+    compressible = ('text/', 'application/javascript', 'application/x-javascript', 
+                    'application/json', 'application/xml', 'image/svg+xml')
+
+    def __init__(self, app, level=6, min_size=256, max_bytes=4 << 20):
+        self.app = app
+        self.level = level
+        self.min_size = min_size
+        self.max_bytes = max_bytes
+        self.cache = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if not accepts(environ, 'gzip') or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.app(environ, self.varying(start_response))
+
+        tags = []
+        if environ.get('HTTP_IF_NONE_MATCH'):
+            tags = [t.strip() for t in environ['HTTP_IF_NONE_MATCH'].split(',')]
+            plain = [t[:-4] + '"' for t in tags if t.endswith('-gz"')]
+            environ['HTTP_IF_NONE_MATCH'] = ', '.join(tags + plain)
+
+        state = {}
+        def xstart_response(status, headers, *args):
+            if 'started' in state:
+                return start_response(status, headers, *args)
+            state['response'] = status, headers, args
+            def write(data):
+                # output written imperatively goes out as it is
+                if 'started' not in state:
+                    state['started'] = start_response(*self.unpack(state.pop('response')))
+                state['started'](data)
+            return write
+
+        result = self.app(environ, xstart_response)
+        if 'response' not in state:
+            # the app either wrote its output already or starts its
+            # response lazily, when iterated; it is passed on unchanged
+            state['started'] = True
+            return result
+
+        status, headers, args = state.pop('response')
+        state['started'] = True
+        h = dict((k.lower(), v) for k, v in headers)
+        etag = h.get('etag')
+        if status[:3] == '304' and etag and gzip_etag(etag) in tags:
+            # the client validated its gzipped copy
+            headers = [(k, k.lower() == 'etag' and gzip_etag(v) or v) for k, v in headers]
+            headers.append(('Vary', 'Accept-Encoding'))
+            start_response(status, headers, *args)
+            return result
+        if not self.negotiable(h):
+            start_response(status, headers, *args)
+            return result
+        headers = headers + [('Vary', 'Accept-Encoding')]
+        if status[:3] != '200' or int(h.get('content-length') or self.min_size) < self.min_size:
+            start_response(status, headers, *args)
+            return result
+
+        f = self.sibling(getattr(result, 'filelike', None))
+        if f:
+            if hasattr(result, 'close'): result.close()
+            headers = self.retag(headers, etag and gzip_etag(etag), os.fstat(f.fileno()).st_size)
+            start_response(status, headers, *args)
+            return environ.get('wsgi.file_wrapper', FileBlocks)(f, 16 * 1024)
+
+        key = None
+        if etag and not etag.startswith('W/'):
+            key = environ.get('PATH_INFO'), etag
+        body = key and self.lookup(key)
+        if body:
+            if hasattr(result, 'close'): result.close()
+            headers = self.retag(headers, gzip_etag(etag), len(body))
+            start_response(status, headers, *args)
+            return [body]
+
+        headers = self.retag(headers, etag and gzip_etag(etag))
+        start_response(status, headers, *args)
+        return self.compress(result, key)
+
+    def unpack(self, response):
+        status, headers, args = response
+        return (status, headers) + args
+
+    def negotiable(self, h):
+        return h.get('content-type', '').startswith(self.compressible) and \
+            'content-encoding' not in h and \
+            'no-transform' not in h.get('cache-control', '')
+
+    def varying(self, start_response):
+        def xstart_response(status, headers, *args):
+            if self.negotiable(dict((k.lower(), v) for k, v in headers)):
+                headers = headers + [('Vary', 'Accept-Encoding')]
+            return start_response(status, headers, *args)
+        return xstart_response
+
+    def retag(self, headers, etag, length=None):
+        # headers of the gzipped variant of a response
+        headers = [(k, v) for k, v in headers 
+                   if k.lower() not in ('content-length', 'etag')]
+        headers.append(('Content-Encoding', 'gzip'))
+        if length is not None:
+            headers.append(('Content-Length', str(length)))
+        if etag:
+            headers.append(('ETag', etag))
+        return headers
+
+    def sibling(self, f):
+        # the up to date .gz sibling of file object f, opened, or None
+        path = getattr(f, 'name', None)
+        if not isinstance(path, str) or not os.path.isfile(path + '.gz'):
+            return None
+        try:
+            if os.path.getmtime(path + '.gz') < os.path.getmtime(path):
+                return None
+            return open(path + '.gz', 'rb')
+        except (IOError, OSError):
+            return None
+
+    def lookup(self, key):
+        self.lock.acquire()
+        try:
+            body = self.cache.pop(key, None)
+            if body is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.cache[key] = body # most recently used goes last
+            return body
+        finally:
+            self.lock.release()
+
+    def store(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        self.lock.acquire()
+        try:
+            if key not in self.cache:
+                self.cache[key] = body
+                self.size += len(body)
+                while self.size > self.max_bytes:
+                    key, old = self.cache.popitem(last=False)
+                    self.size -= len(old)
+        finally:
+            self.lock.release()
+
+    def compress(self, result, key=None):
+        # gzips result chunk by chunk; with a key, the whole of the 
+        # compressed output is kept for the next requests too
+        z = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        kept = key and []
+        try:
+            for chunk in result:
+                data = z.compress(chunk)
+                if data:
+                    if key: kept.append(data)
+                    yield data
+            data = z.flush()
+            if key:
+                kept.append(data)
+                self.store(key, ''.join(kept))
+            yield data
+        finally:
+            if hasattr(result, 'close'): result.close()
+
+def FileBlocks(f, block_size):
+    # the file iteration of wsgi.file_wrapper, for servers without one
+    while True:
+        buf = f.read(block_size)
+        if not buf:
+            break
+        yield buf
+    f.close()
+
 def runbasic(func, server_address=("0.0.0.0", 8080)):
     """
     Runs a simple HTTP server hosting WSGI app `func`. The directory `static/` 
@@ -134,6 +528,18 @@ def runsimple(func, server_address=("0.0.0.0", 8080)):
     Runs [CherryPy][cp] WSGI server hosting WSGI app `func`. 
     The directory `static/` is hosted statically.
 
+    When `web.config.workers` is more than 1, the server runs in that 
+    many processes forked by a `wsgiserver.Supervisor` (POSIX only).
+
+    With `web.config.server_autoscale` set, each process's pool of 
+    threads grows with the load, up to `web.config.server_max_threads` 
+    (64 by default), and shrinks back when it is idle.
+
+    Under overload, requests get a quick 503 once 
+    `web.config.server_max_queue` connections are queued or when one 
+    waited more than `web.config.server_deadline` seconds for a thread 
+    (0, the default, disables either limit).
+
     [cp]: http://www.cherrypy.org
     """
     from wsgiserver import CherryPyWSGIServer
@@ -150,15 +556,94 @@ def runsimple(func, server_address=("0.0.0.0", 8080)):
         def send_response(self, status, msg=""):
             self.status = str(status) + " " + msg
 
-        def send_header(self, name, value):
-            self.headers.append((name, value))
-
         def end_headers(self):
             pass
 
         def log_message(*a): pass
 
-        def __iter__(self):
+        def send_header(self, name, value):
+            self.headers.append((name, value))
+            if name == 'Last-Modified':
+                self.headers.extend(cache_control(self.path))
+
+        def translate_path(self, path):
+            # fingerprinted copies made by a build are kept apart from the 
+            # source tree, under web.config.asset_dir
+            path = SimpleHTTPRequestHandler.translate_path(self, path)
+            root = web.config.get('asset_dir')
+            if root and FINGERPRINTED.search(path):
+                copy = os.path.join(os.path.abspath(root), os.path.relpath(path))
+                if os.path.isfile(copy): return copy
+            return path
+
+        def not_modified(self, etag, mtime):
+            # If-None-Match wins over If-Modified-Since when both are sent
+            env = self.environ
+            if 'HTTP_IF_NONE_MATCH' in env:
+                tags = [t.strip() for t in env['HTTP_IF_NONE_MATCH'].split(',')]
+                return '*' in tags or etag in tags or 'W/' + etag in tags
+            since = net.parsehttpdate(env.get('HTTP_IF_MODIFIED_SINCE', '').split(';')[0])
+            return since is not None and \
+                int(mtime) <= calendar.timegm(since.timetuple())
+
+        def send_entry(self, entry):
+            # like send_head, for a file in the static cache
+            variant = entry.plain
+            if entry.gzip and accepts(self.environ, 'gzip'):
+                variant = entry.gzip
+            if self.not_modified(variant.etag, entry.mtime):
+                self.send_response(304, "Not Modified")
+                self.headers.extend(variant.validators)
+                return None
+            self.send_response(200)
+            self.headers.extend(variant.headers)
+            return StringIO(variant.body)
+
+        def send_head(self):
+            path = self.translate_path(self.path)
+            entry = static_cache.get(path, self.guess_type)
+            if entry:
+                return self.send_entry(entry)
+            if not os.path.isfile(path):
+                return SimpleHTTPRequestHandler.send_head(self)
+
+            # serve the precompressed .gz sibling of a file when there is 
+            # an up to date one and the client accepts gzip
+            gz = path + '.gz'
+            vary = os.path.isfile(gz)
+            if vary and accepts(self.environ, 'gzip') and \
+            os.path.getmtime(gz) >= os.path.getmtime(path):
+                served, coding = gz, 'gzip'
+            else:
+                served, coding = path, None
+            try:
+                f = open(served, 'rb')
+            except IOError:
+                self.send_error(404, "File not found")
+                return None
+
+            # mtime and size make the validators, tagged by encoding so
+            # caches never mix up the plain and the gzipped variant
+            fs = os.fstat(f.fileno())
+            etag = '"%x-%x%s"' % (int(fs.st_mtime), fs.st_size, coding and '-gz' or '')
+            if self.not_modified(etag, fs.st_mtime):
+                f.close()
+                self.send_response(304, "Not Modified")
+                f = None
+            else:
+                self.send_response(200)
+                self.send_header("Content-type", self.guess_type(path))
+                if coding:
+                    self.send_header("Content-Encoding", coding)
+                self.send_header("Content-Length", str(fs.st_size))
+            if vary:
+                self.send_header("Vary", "Accept-Encoding")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+            self.end_headers()
+            return f
+
+        def __call__(self):
             environ = self.environ
 
             self.path = environ.get('PATH_INFO', '')
@@ -166,23 +651,19 @@ def runsimple(func, server_address=("0.0.0.0", 8080)):
                                   environ.get('REMOTE_PORT','-')
             self.command = environ.get('REQUEST_METHOD', '-')
 
-            from cStringIO import StringIO
             self.wfile = StringIO() # for capturing error
 
             f = self.send_head()
             self.start_response(self.status, self.headers)
 
             if f:
+                # the server's file_wrapper can send the file without 
+                # reading it into python, e.g. with sendfile()
                 block_size = 16 * 1024
-                while True:
-                    buf = f.read(block_size)
-                    if not buf:
-                        break
-                    yield buf
-                f.close()
+                file_wrapper = environ.get('wsgi.file_wrapper', FileBlocks)
+                return file_wrapper(f, block_size)
             else:
-                value = self.wfile.getvalue()
-                yield value
+                return [self.wfile.getvalue()]
                     
     class WSGIWrapper(BaseHTTPRequestHandler):
         """WSGI wrapper for logging the status and serving static files."""
@@ -200,7 +681,7 @@ def runsimple(func, server_address=("0.0.0.0", 8080)):
             if path.startswith('/Tests/') or \
             path.startswith('/Extras/') or \
             path.startswith('/Examples/'):
-                return StaticApp(environ, xstart_response)
+                return StaticApp(environ, xstart_response)()
             else:
                 return self.app(environ, xstart_response)
 
@@ -221,8 +702,20 @@ def runsimple(func, server_address=("0.0.0.0", 8080)):
             
     func = WSGIWrapper(func)
     server = CherryPyWSGIServer(server_address, func, server_name="localhost")
+    # browsers keep connections open between page loads; let them
+    # idle without each holding on to a worker thread
+    server.poll_idle = os.name == 'posix'
+    server.requests.autoscale = web.config.get('server_autoscale', False)
+    server.requests.max = web.config.get('server_max_threads', 64)
+    server.requests.max_queue = web.config.get('server_max_queue', 0)
+    server.requests.deadline = web.config.get('server_deadline', 0)
 
     print "http://%s:%d/" % server_address
+    workers = web.config.get('workers', 1)
+    if workers > 1 and hasattr(os, 'fork'):
+        from wsgiserver import Supervisor
+        Supervisor(server, workers).start()
+        return
     try:
         server.start()
     except KeyboardInterrupt:
@@ -40,6 +40,17 @@ import tokenize
 import os
 import glob
 import re
+import sys
+import time
+import imp
+import marshal
+
+try:
+    import hashlib
+    sha1 = hashlib.sha1
+except ImportError:
+    import sha
+    sha1 = sha.new
 
 from utils import storage, safeunicode, safestr, re_compile
 from webapi import config
@@ -860,6 +871,15 @@ class Template(BaseTemplate):
     generate_code = staticmethod(generate_code)
         
     def compile_template(self, template_string, filename):
+        path = bytecode_path(template_string, filename)
+        compiled_code = path and load_bytecode(path)
+        if compiled_code is None:
+            compiled_code = self._compile_template(template_string, filename)
+            if path:
+                save_bytecode(path, compiled_code)
+        return compiled_code
+        
+    def _compile_template(self, template_string, filename):
         code = Template.generate_code(template_string, filename)
     
         def get_source_line(filename, lineno):
@@ -888,6 +908,64 @@ class Template(BaseTemplate):
 
         return compiled_code
         
+def bytecode_path(template_string, filename):
+    """Returns the file the compiled code of a template is cached in, or
+    None when `config.template_cache_dir` isn't set.
+    
+    The name is a hash of the filename, which indexes the cached
+    templates by file (see save_bytecode), then a hash of the template,
+    its filename (kept in the code for tracebacks) and the versions of
+    web.py and of the bytecode, so a cached template is never used for a
+    changed one.
+    """
+    dir = config.get('template_cache_dir')
+    if not dir:
+        return None
+    import web
+    key = sha1('\0'.join([web.__version__, imp.get_magic(),
+        safestr(filename), safestr(template_string)]))
+    index = sha1(safestr(filename)).hexdigest()[:16]
+    return os.path.join(dir, '%s.%s.tplc' % (index, key.hexdigest()))
+    
+def load_bytecode(path):
+    """Returns the code cached at `path`, or None."""
+    try:
+        f = open(path, 'rb')
+        try:
+            return marshal.loads(f.read())
+        finally:
+            f.close()
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+        
+def save_bytecode(path, code):
+    """Caches code (already checked by SafeVisitor) at `path`, removing
+    the code cached for earlier versions of the same template file.
+    """
+    try:
+        dir = os.path.dirname(path)
+        if dir and not os.path.isdir(dir):
+            os.makedirs(dir)
+        # other processes may be loading it: write it whole, then rename.
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        f = open(tmp, 'wb')
+        try:
+            f.write(marshal.dumps(code))
+        finally:
+            f.close()
+        os.rename(tmp, path)
+        
+        prefix = os.path.basename(path).split('.')[0] + '.'
+        for name in os.listdir(dir or '.'):
+            if name.startswith(prefix) and name.endswith('.tplc') and \
+               name != os.path.basename(path):
+                try:
+                    os.remove(os.path.join(dir, name))
+                except OSError:
+                    pass
+    except (IOError, OSError):
+        pass
+        
 class CompiledTemplate(Template):
     def __init__(self, f, filename):
         Template.__init__(self, '', filename)
@@ -909,18 +987,29 @@ class Render:
     every template through the base template.
     
         render = web.template.render('templates', base='layout')
+    
+    Compiled templates are cached. With `cache='reload'`, the default
+    in debug mode, a template is compiled again when its file changes;
+    files are checked at most every `reload_interval` seconds. With
+    `cache=False`, templates are loaded on every use.
     """
+    reload_interval = 1.0
+    
     def __init__(self, loc='templates', cache=None, base=None, **keywords):
         self._loc = loc
         self._keywords = keywords
 
         if cache is None:
-            cache = not config.get('debug', False)
+            cache = config.get('debug', False) and 'reload' or True
         
         if cache:
             self._cache = {}
         else:
             self._cache = None
+        self._reload = cache == 'reload'
+        # name -> (path, stat of the file when loaded, time last checked)
+        self._stamps = {}
+        self._index = None
         
         if base and not hasattr(base, '__call__'):
             # make base a function, so that it can be passed to sub-renders
@@ -929,6 +1018,8 @@ class Render:
             self._base = base
             
     def _lookup(self, name):
+        if self._index and name in self._index:
+            return self._index[name]
         path = os.path.join(self._loc, name)
         if os.path.isdir(path):
             return 'dir', path
@@ -943,19 +1034,94 @@ class Render:
         kind, path = self._lookup(name)
         
         if kind == 'dir':
-            return Render(path, cache=self._cache is not None, base=self._base, **self._keywords)
+            cache = self._reload and 'reload' or self._cache is not None
+            return Render(path, cache=cache, base=self._base, **self._keywords)
         elif kind == 'file':
+            if self._reload:
+                # stat before reading, so that a change while reading
+                # is seen next time.
+                self._stamps[name] = path, self._stat(path), time.time()
             return Template(open(path).read(), filename=path, **self._keywords)
         else:
             raise AttributeError, "No template named " + name            
 
+    def preload(self, threads=None):
+        """Finds and compiles all the templates under the directory of the
+        render now, instead of when each is first used, so that no request
+        waits on the disk or the compiler. Returns the render.
+        
+            render = web.template.render('templates').preload()
+        
+        With `threads`, that many threads compile the templates. When
+        templates aren't cached (in debug mode) they are compiled only to
+        fill `config.template_cache_dir`, and just the index of their
+        files is kept.
+        """
+        index = {}
+        top = os.path.join(self._loc, '')
+        for dirpath, dirnames, filenames in os.walk(self._loc):
+            dir = os.path.join(dirpath, '')[len(top):]
+            for d in dirnames:
+                index[dir + d] = 'dir', os.path.join(dirpath, d)
+            for f in sorted(filenames):
+                name = f.split('.')[0]
+                if name and '.' in f and not f.endswith('~'):
+                    index.setdefault(dir + name, ('file', os.path.join(dirpath, f)))
+        self._index = index
+        
+        names = [name for name, (kind, path) in index.items() if kind == 'file']
+        errors = []
+        def load():
+            while names:
+                try:
+                    name = names.pop()
+                except IndexError:
+                    return
+                try:
+                    t = self._load_template(name)
+                except:
+                    errors.append(sys.exc_info())
+                    return
+                if self._cache is not None:
+                    self._cache[name] = t
+        
+        if threads > 1:
+            import threading
+            workers = [threading.Thread(target=load) for i in range(threads)]
+            for w in workers: w.start()
+            for w in workers: w.join()
+        else:
+            load()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return self
+
     def _findfile(self, path_prefix): 
         p = [f for f in glob.glob(path_prefix + '.*') if not f.endswith('~')] # skip backup files
         return p and p[0]
             
+    def _stat(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return st.st_mtime, st.st_size
+        
+    def _changed(self, name):
+        """Tells whether the file of template `name` changed since it was
+        loaded, looking at most every `reload_interval` seconds."""
+        if name not in self._stamps:
+            return False
+        path, stat, checked = self._stamps[name]
+        now = time.time()
+        if now - checked < self.reload_interval:
+            return False
+        self._stamps[name] = path, stat, now
+        return self._stat(path) != stat
+            
     def _template(self, name):
         if self._cache is not None:
-            if name not in self._cache:
+            if name not in self._cache or self._reload and self._changed(name):
                 self._cache[name] = self._load_template(name)
             return self._cache[name]
         else:
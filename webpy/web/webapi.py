@@ -25,7 +25,7 @@ config.__doc__ = """
 A configuration object for various aspects of web.py.
 
 `debug`
-   : when True, enables reloading, disabled template caching and sets internalerror to debugerror.
+   : when True, enables reloading, reloads changed templates and sets internalerror to debugerror.
 """
 
 class HTTPError(Exception):
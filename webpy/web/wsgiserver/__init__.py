@@ -83,6 +83,7 @@ import Queue
 import re
 quoted_slash = re.compile("(?i)%2F")
 import rfc822
+import select
 import socket
 try:
     import cStringIO as StringIO
@@ -246,6 +247,70 @@ class SizeCheckWrapper(object):
         return data
 
 
+def _sendfile():
+    """Return a sendfile(out_fd, in_fd, offset, count) function, or None.
+    
+    os.sendfile is used where Python has it. Otherwise, on Linux, the C
+    library's sendfile64 is called through ctypes. Like os.sendfile, the
+    function returns the number of bytes sent and raises OSError.
+    """
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        impl = libc.sendfile64
+    except (ImportError, OSError, AttributeError):
+        return None
+    impl.argtypes = [ctypes.c_int, ctypes.c_int,
+                     ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    impl.restype = ctypes.c_ssize_t
+    
+    def sendfile(out_fd, in_fd, offset, count):
+        offset = ctypes.c_int64(offset)
+        sent = impl(out_fd, in_fd, ctypes.byref(offset), count)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+    return sendfile
+
+sendfile = _sendfile()
+
+sendfile_errors_to_fallback = plat_specific_errors(
+    "EINVAL", "ENOSYS", "ENOTSUP", "EOPNOTSUPP")
+
+
+class FileWrapper(object):
+    """The wsgi.file_wrapper of this server (PEP 333).
+    
+    Iterating over it reads the file in blocks, as any server would. When
+    an application returns one, HTTPRequest tries to hand the file to the
+    kernel with sendfile() instead, which copies it to the socket without
+    passing the data through Python.
+    """
+    
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+    
+    def __iter__(self):
+        return self
+    
+    def next(self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration
+    
+    def close(self):
+        if hasattr(self.filelike, "close"):
+            self.filelike.close()
+
+
 class HTTPRequest(object):
     """An HTTP Request (and response).
     
@@ -279,10 +344,17 @@ class HTTPRequest(object):
     chunked_write: if True, output will be encoded with the "chunked"
         transfer-coding. This value is set automatically inside
         send_headers.
+    outbuf: output (status line, headers, body and chunk framing) waiting
+        to be sent. It is sent in a single call once write_buffer_size
+        bytes are pending and at the end of the response, so that a small
+        page goes out in one write. When the client has pipelined another
+        request, the connection hands outbuf on to it (see carry) and
+        both responses go out together.
     """
     
     max_request_header_size = 0
     max_request_body_size = 0
+    write_buffer_size = 16384
     
     def __init__(self, wfile, environ, wsgi_app):
         self.rfile = environ['wsgi.input']
@@ -297,6 +369,19 @@ class HTTPRequest(object):
         self.sent_headers = False
         self.close_connection = False
         self.chunked_write = False
+        
+        self.outbuf = []
+        self.outlen = 0
+        # Where this response starts in outbuf, and whether any of it
+        # has been sent already (after which it can't be taken back).
+        self.outmark = 0
+        self.flushed = False
+    
+    def carry(self, req):
+        """Take over the unsent output of a previous (pipelined) request."""
+        self.outbuf = req.outbuf
+        self.outlen = req.outlen
+        self.outmark = len(self.outbuf)
     
     def parse_request(self):
         """Parse the next HTTP request start-line and message-headers."""
@@ -541,7 +626,13 @@ class HTTPRequest(object):
         self.rfile.bytes_read = 0
         
         try:
-            self._respond()
+            try:
+                self._respond()
+            except:
+                # Unless some of it went out already, drop the partial
+                # response so that an error response can replace it.
+                self.discard()
+                raise
         except MaxSizeExceeded:
             if not self.sent_headers:
                 self.simple_response("413 Request Entity Too Large")
@@ -555,6 +646,13 @@ class HTTPRequest(object):
         
         response = self.wsgi_app(self.environ, self.start_response)
         try:
+            if isinstance(response, FileWrapper) and self.send_file(response):
+                response = ()
+            # The blocks of a list are all at hand and may share a write;
+            # "WSGI servers, gateways, and middleware must not delay the
+            # transmission of any block" of an iterator, which may be
+            # slow to produce the next one (PEP 333).
+            streaming = not isinstance(response, (list, tuple))
             for chunk in response:
                 # "The start_response callable must not actually transmit
                 # the response headers. Instead, it must store them for the
@@ -563,7 +661,9 @@ class HTTPRequest(object):
                 # a NON-EMPTY string, or upon the application's first
                 # invocation of the write() callable." (PEP 333)
                 if chunk:
-                    self.write(chunk)
+                    self.send_body(chunk)
+                    if streaming:
+                        self.flush()
         finally:
             if hasattr(response, "close"):
                 response.close()
@@ -572,7 +672,7 @@ class HTTPRequest(object):
             self.sent_headers = True
             self.send_headers()
         if self.chunked_write:
-            self.wfile.sendall("0\r\n\r\n")
+            self.buffer("0\r\n\r\n")
     
     def simple_response(self, status, msg=""):
         """Write a simple response back to the client."""
@@ -590,6 +690,10 @@ class HTTPRequest(object):
         if msg:
             buf.append(msg)
         
+        # Responses to earlier pipelined requests go first.
+        buf = self.outbuf + buf
+        self.outbuf = []
+        self.outlen = self.outmark = 0
         try:
             self.wfile.sendall("".join(buf))
         except socket.error, x:
@@ -619,10 +723,15 @@ class HTTPRequest(object):
         return self.write
     
     def write(self, chunk):
-        """WSGI callable to write unbuffered data to the client.
+        """WSGI callable to write unbuffered data to the client."""
+        self.send_body(chunk)
+        self.flush()
+    
+    def send_body(self, chunk):
+        """Add a chunk of the response body (after the headers) to outbuf.
         
-        This method is also used internally by start_response (to write
-        data from the iterable returned by the WSGI application).
+        This method is used by write() and by _respond (to write data
+        from the iterable returned by the WSGI application).
         """
         if not self.started_response:
             raise AssertionError("WSGI write called before start_response.")
@@ -632,10 +741,93 @@ class HTTPRequest(object):
             self.send_headers()
         
         if self.chunked_write and chunk:
-            buf = [hex(len(chunk))[2:], "\r\n", chunk, "\r\n"]
-            self.wfile.sendall("".join(buf))
+            self.buffer(hex(len(chunk))[2:] + "\r\n")
+            self.buffer(chunk)
+            self.buffer("\r\n")
         else:
-            self.wfile.sendall(chunk)
+            self.buffer(chunk)
+    
+    def buffer(self, data):
+        """Queue data for the client, sending it once enough is pending."""
+        self.outbuf.append(data)
+        self.outlen += len(data)
+        if self.outlen >= self.write_buffer_size:
+            self.flush()
+    
+    def flush(self):
+        """Send all pending output to the client in one call."""
+        if not self.outbuf:
+            return
+        if len(self.outbuf) > self.outmark:
+            self.flushed = True
+        data = "".join(self.outbuf)
+        self.outbuf = []
+        self.outlen = self.outmark = 0
+        self.wfile.sendall(data)
+    
+    def discard(self):
+        """Drop the pending output of this response, unless some was sent.
+        
+        Output of earlier pipelined responses is kept. Afterwards the
+        headers count as unsent, so another response may be started.
+        """
+        if self.flushed:
+            return
+        for data in self.outbuf[self.outmark:]:
+            self.outlen -= len(data)
+        del self.outbuf[self.outmark:]
+        self.sent_headers = False
+        self.chunked_write = False
+    
+    def send_file(self, wrapper):
+        """Write the file of a FileWrapper to the client using sendfile().
+        
+        Returns False if sendfile() can't be used, because the platform
+        lacks it, the connection is SSL, the file has no descriptor or the
+        response has no Content-Length (and would be chunked). The caller
+        should then iterate over the wrapper as usual.
+        """
+        if (sendfile is None or not self.started_response
+            or isinstance(self.wfile, SSL_fileobject)):
+            return False
+        if "content-length" not in [k.lower() for k, v in self.outheaders]:
+            return False
+        try:
+            in_fd = wrapper.filelike.fileno()
+            offset = wrapper.filelike.tell()
+        except (AttributeError, IOError, OSError):
+            return False
+        
+        if not self.sent_headers:
+            self.sent_headers = True
+            self.send_headers()
+        self.flush()
+        
+        sock = self.wfile._sock
+        remaining = os.fstat(in_fd).st_size - offset
+        start = offset
+        while remaining > 0:
+            try:
+                sent = sendfile(sock.fileno(), in_fd, offset, remaining)
+            except OSError, e:
+                if e.errno in socket_errors_nonblocking:
+                    # The socket has a timeout, so it's non-blocking.
+                    r, w, x = select.select([], [sock], [], sock.gettimeout())
+                    if not w:
+                        raise socket.timeout("timed out")
+                    continue
+                if e.errno in socket_error_eintr:
+                    continue
+                if e.errno in sendfile_errors_to_fallback and offset == start:
+                    # e.g. a file system without sendfile support;
+                    # nothing was sent yet, so the wrapper can take over.
+                    return False
+                raise socket.error(e.errno, e.strerror)
+            if not sent:
+                break
+            offset += sent
+            remaining -= sent
+        return True
     
     def send_headers(self):
         """Assert, process, and send the HTTP response message-headers."""
@@ -705,7 +897,7 @@ class HTTPRequest(object):
             else:
                 raise
         buf.append("\r\n")
-        self.wfile.sendall("".join(buf))
+        self.buffer("".join(buf))
 
 
 class NoSSLError(Exception):
@@ -1123,12 +1315,19 @@ class HTTPConnection(object):
     
     rbufsize = -1
     RequestHandlerClass = HTTPRequest
+    
+    # Set by the server when a ConnectionPoller watches its idle
+    # connections; communicate() then returns between requests, with
+    # idle set, instead of blocking until the next one arrives.
+    poller = None
+    idle = False
     environ = {"wsgi.version": (1, 0),
                "wsgi.url_scheme": "http",
                "wsgi.multithread": True,
                "wsgi.multiprocess": False,
                "wsgi.run_once": False,
                "wsgi.errors": sys.stderr,
+               "wsgi.file_wrapper": FileWrapper,
                }
     
     def __init__(self, sock, wsgi_app, environ):
@@ -1157,22 +1356,38 @@ class HTTPConnection(object):
     
     def communicate(self):
         """Read each request and respond appropriately."""
+        req = None
         try:
             while True:
                 # (re)set req to None so that if something goes wrong in
                 # the RequestHandlerClass constructor, the error doesn't
                 # get written to the previous request.
-                req = None
+                pending, req = req, None
                 req = self.RequestHandlerClass(self.wfile, self.environ,
                                                self.wsgi_app)
+                if pending:
+                    req.carry(pending)
                 
                 # This order of operations should guarantee correct pipelining.
                 req.parse_request()
                 if not req.ready:
+                    req.flush()
                     return
                 
                 req.respond()
                 if req.close_connection:
+                    req.flush()
+                    return
+                
+                if not self.pipelined():
+                    # Hold the response back only while the client has
+                    # already sent the next request to answer with it.
+                    req.flush()
+                
+                if self.poller and not self.buffered():
+                    # Nothing pipelined: let the poller wait for the
+                    # next request instead of tying up this thread.
+                    self.idle = True
                     return
         
         except socket.error, e:
@@ -1201,6 +1416,32 @@ class HTTPConnection(object):
             if req and not req.sent_headers:
                 req.simple_response("500 Internal Server Error", format_exc())
     
+    def buffered(self):
+        """Return the number of bytes read from the socket but not consumed."""
+        buf = self.rfile._rbuf
+        if _fileobject_uses_str_type:
+            return len(buf)
+        buf.seek(0, 2)
+        return buf.tell()
+    
+    def pipelined(self):
+        """Return True if the head of another request is already buffered."""
+        buf = self.rfile._rbuf
+        if not _fileobject_uses_str_type:
+            buf = buf.getvalue()
+        head = buf.lstrip("\r\n")
+        return "\n\r\n" in head or "\n\n" in head
+    
+    def unread(self, data):
+        """Push data (read from the socket elsewhere) back in front of rfile."""
+        buf = self.rfile._rbuf
+        if _fileobject_uses_str_type:
+            self.rfile._rbuf = data + buf
+        else:
+            buf.seek(0)
+            self.rfile._rbuf = StringIO.StringIO()
+            self.rfile._rbuf.write(data + buf.read())
+    
     def close(self):
         """Close the socket underlying this connection."""
         self.rfile.close()
@@ -1259,7 +1500,11 @@ class WorkerThread(threading.Thread):
                 try:
                     conn.communicate()
                 finally:
-                    conn.close()
+                    if conn.idle:
+                        conn.idle = False
+                        self.server.poller.put(conn)
+                    else:
+                        conn.close()
                     self.conn = None
         except (KeyboardInterrupt, SystemExit), exc:
             self.server.interrupt = exc
@@ -1270,15 +1515,42 @@ class ThreadPool(object):
     
     ThreadPool objects must provide min, get(), put(obj), start()
     and stop(timeout) attributes.
+    
+    With autoscale set, scale() (called by the server on every tick) 
+    grows the pool, up to max, when more than grow_depth connections are
+    queued or one waited more than grow_wait seconds for a thread, and
+    shrinks it back towards min once threads have been idle for 
+    shrink_after seconds. The queue_depth, wait_time (a moving average)
+    and max_wait attributes describe the load it saw.
+    
+    To keep latency bounded under overload, put() raises Queue.Full when
+    max_queue connections are already waiting, and connections which
+    waited more than deadline seconds are handed to server.shed()
+    instead of a worker (0, the default, disables either limit). The
+    rejected attribute counts both.
     """
     
+    max_queue = 0
+    deadline = 0
+    
+    autoscale = False
+    grow_depth = 0
+    grow_wait = 0.05
+    shrink_after = 30
+    scale_interval = 1.0
+    
     def __init__(self, server, min=10, max=-1):
         self.server = server
         self.min = min
         self.max = max
         self._threads = []
         self._queue = Queue.Queue()
-        self.get = self._queue.get
+        self._lock = threading.Lock()
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.rejected = 0
+        self._next_scale = 0
+        self._busy_at = time.time()
     
     def start(self):
         """Start the pool of threads."""
@@ -1296,10 +1568,62 @@ class ThreadPool(object):
         return len([t for t in self._threads if t.conn is None])
     idle = property(_get_idle, doc=_get_idle.__doc__)
     
+    def _get_queue_depth(self):
+        """Number of connections waiting for a worker thread. Read-only."""
+        return self._queue.qsize()
+    queue_depth = property(_get_queue_depth, doc=_get_queue_depth.__doc__)
+    
     def put(self, obj):
-        self._queue.put(obj)
-        if obj is _SHUTDOWNREQUEST:
-            return
+        if obj is not _SHUTDOWNREQUEST:
+            for conn in self._expired():
+                self.server.shed(conn)
+            if self.max_queue and self._queue.qsize() >= self.max_queue:
+                self._count_rejected()
+                raise Queue.Full
+        self._queue.put((obj, time.time()))
+    
+    def get(self):
+        while True:
+            obj, queued = self._queue.get()
+            if obj is _SHUTDOWNREQUEST:
+                return obj
+            wait = time.time() - queued
+            if self.deadline and wait > self.deadline:
+                self._count_rejected()
+                self.server.shed(obj)
+                continue
+            self._lock.acquire()
+            self.wait_time = 0.9 * self.wait_time + 0.1 * wait
+            self.max_wait = max(self.max_wait, wait)
+            self._lock.release()
+            return obj
+    
+    def _expired(self):
+        """Pop the connections past their deadline off the head of the Queue."""
+        expired = []
+        if not self.deadline:
+            return expired
+        q = self._queue
+        oldest = time.time() - self.deadline
+        q.mutex.acquire()
+        try:
+            while q.queue:
+                obj, queued = q.queue[0]
+                if obj is _SHUTDOWNREQUEST or queued >= oldest:
+                    break
+                q.queue.popleft()
+                q.unfinished_tasks -= 1
+                expired.append(obj)
+        finally:
+            q.mutex.release()
+        for conn in expired:
+            self._count_rejected()
+        return expired
+    
+    def _count_rejected(self):
+        self._lock.acquire()
+        self.rejected += 1
+        self._lock.release()
     
     def grow(self, amount):
         """Spawn new worker threads (not above self.max)."""
@@ -1315,7 +1639,7 @@ class ThreadPool(object):
         """Kill off worker threads (not below self.min)."""
         # Grow/shrink the pool if necessary.
         # Remove any dead threads from our list
-        for t in self._threads:
+        for t in self._threads[:]:
             if not t.isAlive():
                 self._threads.remove(t)
                 amount -= 1
@@ -1326,13 +1650,38 @@ class ThreadPool(object):
                 # to 'amount'. Once each of those is processed by a worker,
                 # that worker will terminate and be culled from our list
                 # in self.put.
-                self._queue.put(_SHUTDOWNREQUEST)
+                self.put(_SHUTDOWNREQUEST)
+    
+    def scale(self):
+        """Grow or shrink the pool to fit the load, if autoscale is set."""
+        now = time.time()
+        if not self.autoscale or now < self._next_scale:
+            return
+        self._next_scale = now + self.scale_interval
+        
+        self._lock.acquire()
+        max_wait, self.max_wait = self.max_wait, 0.0
+        self._lock.release()
+        
+        self._threads = [t for t in self._threads if t.isAlive()]
+        depth = self.queue_depth
+        idle = self.idle
+        if depth > self.grow_depth or max_wait > self.grow_wait:
+            self.grow(max(depth - idle, 1))
+            self._busy_at = now
+        elif idle == 0:
+            self._busy_at = now
+        elif (now - self._busy_at > self.shrink_after
+              and len(self._threads) > self.min):
+            # Give back half of the spare threads at a time.
+            self.shrink(max(min(idle, len(self._threads) - self.min) // 2, 1))
+            self._busy_at = now
     
     def stop(self, timeout=5):
         # Must shut down threads here so the code that calls
         # this method can know when all threads are stopped.
         for worker in self._threads:
-            self._queue.put(_SHUTDOWNREQUEST)
+            self.put(_SHUTDOWNREQUEST)
         
         # Don't join currentThread (when stop is called inside a request).
         current = threading.currentThread()
@@ -1363,6 +1712,203 @@ class ThreadPool(object):
 
 
 
+class ConnectionPoller(object):
+    """Watches the idle connections of a CherryPyWSGIServer.
+    
+    New connections, and connections kept alive between requests, are
+    polled by the server's acceptor thread (with epoll, poll or select,
+    whichever the platform has) along with the listening socket. Request
+    headers are read as they arrive, and a connection is put on the
+    request Queue only once its request line and headers are complete,
+    so slow or idle clients don't tie up the worker threads.
+    
+    server: the CherryPyWSGIServer this poller accepts connections for.
+    timeout: seconds after which a connection which hasn't sent a
+        complete request is closed (defaults to the server's timeout).
+    max_header_size: connections which have sent this many bytes
+        without ending their headers are dispatched anyway, so that
+        HTTPRequest can reject them.
+    """
+    
+    bufsize = 16 * 1024
+    max_header_size = 64 * 1024
+    
+    def __init__(self, server, timeout=None):
+        self.server = server
+        self.timeout = timeout or server.timeout
+        self.closed = False
+        self._conns = {}
+        self._pending = []
+        self._lock = threading.Lock()
+        self._next_sweep = time.time() + 1
+        
+        if hasattr(select, "epoll"):
+            self._epoll = select.epoll()
+        elif hasattr(select, "poll"):
+            self._poll = select.poll()
+        else:
+            self._fds = set()
+        
+        # Worker threads hand connections back through put(); writing to
+        # this pipe wakes the acceptor thread up to register them.
+        self._wakeup, self._waker = os.pipe()
+        import fcntl
+        flags = fcntl.fcntl(self._waker, fcntl.F_GETFL)
+        fcntl.fcntl(self._waker, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self._register(self._wakeup)
+        self._listener = server.socket.fileno()
+        self._register(self._listener)
+        # Workers forked by a Supervisor share the listener, and all their
+        # pollers may see it readable for a connection only one of them
+        # gets. The others must not wait in accept() for the next one.
+        server.socket.settimeout(0)
+    
+    def _register(self, fd):
+        if hasattr(self, "_epoll"):
+            self._epoll.register(fd, select.EPOLLIN | select.EPOLLPRI)
+        elif hasattr(self, "_poll"):
+            self._poll.register(fd, select.POLLIN | select.POLLPRI)
+        else:
+            self._fds.add(fd)
+    
+    def _unregister(self, fd):
+        try:
+            if hasattr(self, "_epoll"):
+                self._epoll.unregister(fd)
+            elif hasattr(self, "_poll"):
+                self._poll.unregister(fd)
+            else:
+                self._fds.discard(fd)
+        except (IOError, OSError, KeyError):
+            pass
+    
+    def _wait(self, timeout):
+        """Return the registered fds which are ready to be read."""
+        try:
+            if hasattr(self, "_epoll"):
+                return [fd for fd, event in self._epoll.poll(timeout)]
+            elif hasattr(self, "_poll"):
+                return [fd for fd, event in self._poll.poll(timeout * 1000)]
+            else:
+                return select.select(list(self._fds), [], [], timeout)[0]
+        except (select.error, IOError, OSError), e:
+            if e.args[0] in socket_error_eintr or self.closed:
+                return []
+            raise
+    
+    def put(self, conn):
+        """Watch conn for its next request. Thread-safe."""
+        self._lock.acquire()
+        try:
+            if self.closed:
+                conn.close()
+                return
+            self._pending.append(conn)
+            try:
+                os.write(self._waker, "x")
+            except OSError:
+                # The pipe is full: the acceptor has a wakeup pending.
+                pass
+        finally:
+            self._lock.release()
+    
+    def tick(self, timeout=1.0):
+        """Accept connections and read request headers for up to timeout seconds."""
+        ready = self._wait(timeout)
+        
+        # The lock keeps close() from running halfway through a tick.
+        self._lock.acquire()
+        try:
+            if self.closed:
+                return
+            for fd in ready:
+                if fd == self._listener:
+                    conn = self.server.accept()
+                    if conn is None:
+                        continue
+                    if SSL and isinstance(conn.socket, SSL.ConnectionType):
+                        # pyOpenSSL buffers internally; let a worker handle it.
+                        self.server.dispatch(conn)
+                    else:
+                        conn.poller = self
+                        self._watch(conn)
+                elif fd == self._wakeup:
+                    os.read(self._wakeup, 4096)
+                    pending, self._pending = self._pending, []
+                    for conn in pending:
+                        self._watch(conn)
+                elif fd in self._conns:
+                    self._read(fd)
+            
+            now = time.time()
+            if now >= self._next_sweep:
+                self._next_sweep = now + 1
+                for fd, (conn, data, deadline) in self._conns.items():
+                    if deadline < now:
+                        self._drop(fd)
+        finally:
+            self._lock.release()
+    
+    def _watch(self, conn):
+        try:
+            fd = conn.socket.fileno()
+        except socket.error:
+            conn.close()
+            return
+        self._conns[fd] = (conn, [], time.time() + self.timeout)
+        self._register(fd)
+    
+    def _drop(self, fd):
+        conn, data, deadline = self._conns.pop(fd)
+        self._unregister(fd)
+        conn.close()
+    
+    def _read(self, fd):
+        conn, data, deadline = self._conns[fd]
+        try:
+            chunk = conn.socket.recv(self.bufsize)
+        except socket.error, e:
+            if (e.args[0] in socket_errors_nonblocking
+                or e.args[0] in socket_error_eintr):
+                return
+            chunk = ""
+        if not chunk:
+            # The client went away.
+            self._drop(fd)
+            return
+        
+        data.append(chunk)
+        head = "".join(data).lstrip("\r\n")
+        del data[:]
+        if head:
+            data.append(head)
+        if ("\n\r\n" in head or "\n\n" in head
+            or len(head) >= self.max_header_size):
+            del self._conns[fd]
+            self._unregister(fd)
+            conn.unread(head)
+            self.server.dispatch(conn)
+    
+    def close(self):
+        """Close all watched connections and stop polling."""
+        self._lock.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+            for conn in self._pending:
+                conn.close()
+            self._pending = []
+            for fd in self._conns.keys():
+                self._drop(fd)
+            if hasattr(self, "_epoll"):
+                self._epoll.close()
+            os.close(self._wakeup)
+            os.close(self._waker)
+        finally:
+            self._lock.release()
+
+
 class SSLConnection:
     """A thread-safe wrapper for an SSL.Connection.
     
@@ -1429,7 +1975,9 @@ class CherryPyWSGIServer(object):
     numthreads: the number of worker threads to create (default 10).
     server_name: the string to set for WSGI's SERVER_NAME environ entry.
         Defaults to socket.gethostname().
-    max: the maximum number of queued requests (defaults to -1 = no limit).
+    max: the maximum number of worker threads, which ThreadPool.grow()
+        respects (defaults to -1 = no limit). Set requests.autoscale to
+        have the pool grow towards it under load.
     request_queue_size: the 'backlog' argument to socket.listen();
         specifies the maximum number of queued connections (default 5).
     timeout: the timeout in seconds for accepted connections (default 10).
@@ -1437,6 +1985,15 @@ class CherryPyWSGIServer(object):
     nodelay: if True (the default since 3.1), sets the TCP_NODELAY socket
         option.
     
+    retry_after: the Retry-After seconds sent with the 503 responses of
+        connections shed because of requests.max_queue or
+        requests.deadline (see ThreadPool).
+    
+    poll_idle: if True, a ConnectionPoller in the acceptor thread waits
+        for the requests of new and kept-alive connections, so that only
+        complete requests occupy the worker threads (default False).
+        POSIX only.
+    
     protocol: the version string to write in the Status-Line of all
         HTTP responses. For example, "HTTP/1.1" (the default). This
         also limits the supported features used in the response.
@@ -1462,6 +2019,9 @@ class CherryPyWSGIServer(object):
     _interrupt = None
     
     nodelay = True
+    poll_idle = False
+    poller = None
+    retry_after = 5
     
     ConnectionClass = HTTPConnection
     environ = {}
@@ -1545,6 +2105,28 @@ class CherryPyWSGIServer(object):
         # trap those exceptions in whatever code block calls start().
         self._interrupt = None
         
+        # A Supervisor binds the socket before forking its workers.
+        if not getattr(self, "socket", None):
+            self.listen()
+        
+        # Create worker threads
+        self.requests.start()
+        
+        if self.poll_idle:
+            self.poller = ConnectionPoller(self)
+        
+        self.ready = True
+        while self.ready:
+            self.tick()
+            if self.interrupt:
+                while self.interrupt is True:
+                    # Wait for self.stop() to complete. See _set_interrupt.
+                    time.sleep(0.1)
+                if self.interrupt:
+                    raise self.interrupt
+    
+    def listen(self):
+        """Create, bind and listen on the socket for bind_addr."""
         # Select the appropriate socket
         if isinstance(self.bind_addr, basestring):
             # AF_UNIX socket
@@ -1587,19 +2169,6 @@ class CherryPyWSGIServer(object):
         # Timeout so KeyboardInterrupt can be caught on Win32
         self.socket.settimeout(1)
         self.socket.listen(self.request_queue_size)
-        
-        # Create worker threads
-        self.requests.start()
-        
-        self.ready = True
-        while self.ready:
-            self.tick()
-            if self.interrupt:
-                while self.interrupt is True:
-                    # Wait for self.stop() to complete. See _set_interrupt.
-                    time.sleep(0.1)
-                if self.interrupt:
-                    raise self.interrupt
     
     def bind(self, family, type, proto=0):
         """Create (or recreate) the actual socket object."""
@@ -1634,6 +2203,50 @@ class CherryPyWSGIServer(object):
     
     def tick(self):
         """Accept a new connection and put it on the Queue."""
+        if hasattr(self.requests, "scale"):
+            self.requests.scale()
+        
+        if self.poller:
+            self.poller.tick()
+            return
+        
+        conn = self.accept()
+        if conn:
+            self.dispatch(conn)
+    
+    def dispatch(self, conn):
+        """Put conn on the Queue, or shed it if the Queue is full."""
+        try:
+            self.requests.put(conn)
+        except Queue.Full:
+            self.shed(conn)
+    
+    def shed(self, conn):
+        """Answer conn with a 503 Service Unavailable and close it."""
+        if not isinstance(conn.wfile, SSL_fileobject):
+            msg = "The server is overloaded; please retry later."
+            buf = ["%s 503 Service Unavailable\r\n" % self.protocol,
+                   "Retry-After: %d\r\n" % self.retry_after,
+                   "Content-Length: %s\r\n" % len(msg),
+                   "Content-Type: text/plain\r\n",
+                   "Connection: close\r\n",
+                   "\r\n", msg]
+            try:
+                conn.wfile.sendall("".join(buf))
+                # Closing a socket with unread input resets the connection,
+                # and the client loses the response. Send our FIN, then read
+                # whatever of the request has arrived (without waiting).
+                conn.socket.shutdown(socket.SHUT_WR)
+                conn.socket.settimeout(0)
+                for i in xrange(16):
+                    if not conn.socket.recv(4096):
+                        break
+            except socket.error:
+                pass
+        conn.close()
+    
+    def accept(self):
+        """Accept a new connection and return it (None if there was none)."""
         try:
             s, addr = self.socket.accept()
             prevent_socket_inheritance(s)
@@ -1664,8 +2277,7 @@ class CherryPyWSGIServer(object):
                 environ["REMOTE_ADDR"] = addr[0]
                 environ["REMOTE_PORT"] = str(addr[1])
             
-            conn = self.ConnectionClass(s, self.wsgi_app, environ)
-            self.requests.put(conn)
+            return self.ConnectionClass(s, self.wsgi_app, environ)
         except socket.timeout:
             # The only reason for the timeout in start() is so we can
             # notice keyboard interrupts on Win32, which don't interrupt
@@ -1734,6 +2346,8 @@ class CherryPyWSGIServer(object):
                 sock.close()
             self.socket = None
         
+        if self.poller:
+            self.poller.close()
         self.requests.stop(self.shutdown_timeout)
     
     def populate_ssl_environ(self):
@@ -1780,3 +2394,137 @@ class CherryPyWSGIServer(object):
                     ssl_environ[wsgikey] = value
         
         self.environ.update(ssl_environ)
+
+
+class Supervisor(object):
+    """Runs a CherryPyWSGIServer in several worker processes (POSIX only).
+    
+    The supervisor binds the server's socket and forks `workers`
+    processes which all accept connections on it, each with its own
+    thread pool, so that CPU bound applications are not limited to one
+    core by the GIL. Workers which die are restarted.
+    
+    Signals sent to the supervisor:
+        SIGHUP: graceful reload; a new set of workers is started, then
+            the old ones finish their requests and exit.
+        SIGTERM, SIGINT: graceful shutdown of all workers.
+    
+    server: the CherryPyWSGIServer to run; it must not be started.
+    workers: the number of worker processes (default 2).
+    """
+    
+    # seconds between checks on the workers
+    interval = 0.5
+    # workers which die sooner than this after starting are restarted
+    # only after the same delay, so a crashing app doesn't fork-bomb.
+    min_lifetime = 1.0
+    
+    def __init__(self, server, workers=2):
+        self.server = server
+        self.workers = workers
+        self.children = {}
+        self.stopping = False
+        self.reloading = False
+    
+    def start(self):
+        """Start the workers and supervise them until told to stop."""
+        import signal
+        
+        self.server.listen()
+        environ = self.server.environ.copy()
+        environ["wsgi.multiprocess"] = True
+        self.server.environ = environ
+        
+        def stop(signum, frame):
+            self.stopping = True
+        def reload(signum, frame):
+            self.reloading = True
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGHUP, reload)
+        
+        try:
+            for i in xrange(self.workers):
+                self.spawn()
+            while not self.stopping:
+                time.sleep(self.interval)
+                self.reap()
+                if self.reloading:
+                    self.reloading = False
+                    old = self.children.keys()
+                    for i in xrange(self.workers):
+                        self.spawn()
+                    self.kill(old)
+                elif not self.stopping:
+                    # Replace dead workers, unless they die too fast.
+                    now = time.time()
+                    for i in xrange(self.workers - len(self.alive())):
+                        if now - self.last_spawn >= self.min_lifetime:
+                            self.spawn()
+        finally:
+            self.kill(self.children.keys())
+            deadline = time.time() + self.server.shutdown_timeout + 1
+            while self.children and time.time() < deadline:
+                time.sleep(0.1)
+                self.reap()
+            self.kill(self.children.keys(), signal.SIGKILL)
+            self.server.socket.close()
+            self.server.socket = None
+    
+    def alive(self):
+        """Pids of the workers which weren't told to stop."""
+        return [pid for pid, killed in self.children.items() if not killed]
+    
+    def spawn(self):
+        """Fork a worker process."""
+        pid = os.fork()
+        if pid:
+            self.children[pid] = False
+            self.last_spawn = time.time()
+            return pid
+        
+        import signal
+        status = 0
+        try:
+            try:
+                # Let the supervisor decide when to stop.
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGHUP, signal.SIG_IGN)
+                def stop(signum, frame):
+                    self.server.ready = False
+                signal.signal(signal.SIGTERM, stop)
+                
+                self.server.start()
+                # The socket is shared with the other workers; don't let
+                # stop() touch it to wake up an accept() which has ended.
+                sock, self.server.socket = self.server.socket, None
+                sock.close()
+                self.server.stop()
+            except:
+                traceback.print_exc()
+                status = 1
+        finally:
+            os._exit(status)
+    
+    def kill(self, pids, sig=None):
+        """Signal the given workers to stop (with SIGTERM by default)."""
+        import signal
+        for pid in pids:
+            try:
+                os.kill(pid, sig or signal.SIGTERM)
+                self.children[pid] = True
+            except OSError:
+                pass
+    
+    def reap(self):
+        """Forget about the workers which exited."""
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            if not pid:
+                break
+            self.children.pop(pid, None)